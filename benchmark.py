@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# End-to-end latency benchmark for lms.py
+#
+# By default a fakelms.py server is started in a separate process, so the
+# CPU time reported here only covers the client side. status_mpris
+# measures up to the point where PropertiesChanged would be emitted, with
+# a stub in place of the D-Bus service.
+#
+# --soak feeds millions of status lines through the status, metadata and
+# MPRIS property pipeline (without D-Bus), reconnecting regularly, and
+# reports whether memory, threads or listener counts grew.
+#
+
+import argparse
+import gc
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import tracing
+from lms import LMS, LMSDiscoverer, my_ips
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(("", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summary(values, scale=1000):
+    """
+    min/median/p95/max of a list of durations, in ms by default
+    """
+    if not values:
+        return {}
+    return {
+        "n": len(values),
+        "min": min(values) * scale,
+        "p50": percentile(values, 50) * scale,
+        "p95": percentile(values, 95) * scale,
+        "max": max(values) * scale,
+    }
+
+
+class BurstListener():
+    """
+    Status listener for a burst. Intermediate updates can be collapsed
+    by the client, so the burst is complete when the last sequence
+    number arrives.
+    """
+
+    def __init__(self, playerid, count):
+        self.playerid = playerid
+        self.count = count
+        self.received = 0
+        self.latencies = []
+        self.done = threading.Event()
+
+    def notify_status(self, playerid, status):
+        now = time.monotonic()
+        if playerid != self.playerid or "bench_ts" not in status:
+            return
+        self.latencies.append(now - float(status["bench_ts"]))
+        self.received += 1
+        if int(status["bench_seq"]) >= self.count - 1:
+            self.done.set()
+
+
+class PropertiesListener():
+    """
+    Stands in for MPRISInterface: records the latency from a status
+    update leaving the server to the PropertiesChanged signal it causes
+    """
+
+    def __init__(self, wrapper, count):
+        self.wrapper = wrapper
+        self.count = count
+        self.signals = 0
+        self.latencies = []
+        self.done = threading.Event()
+
+    def properties_changed(self, props):
+        now = time.monotonic()
+        # called from notify_status, right after the status was stored
+        status = self.wrapper.last_lms_status
+        if "bench_ts" not in status:
+            return
+        self.latencies.append(now - float(status["bench_ts"]))
+        self.signals += 1
+        if int(status["bench_seq"]) >= self.count - 1:
+            self.done.set()
+
+
+class FakeServerProcess():
+
+    def __init__(self, verbose=False):
+        self.port = free_port()
+        self.discovery_port = free_port(socket.SOCK_DGRAM)
+        self.http_port = free_port()
+        cmd = [sys.executable,
+               os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "fakelms.py"),
+               "--port", str(self.port),
+               "--discovery-port", str(self.discovery_port),
+               "--http-port", str(self.http_port)]
+        if verbose:
+            cmd.append("-v")
+        self.process = subprocess.Popen(cmd)
+        self.wait_ready()
+
+    def wait_ready(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise IOError("fake LMS did not start")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def bench_connect(host, port, rounds):
+    times = []
+    for _i in range(rounds):
+        lms = LMS(host=host, port=port)
+        start = time.perf_counter()
+        lms.connect()
+        times.append(time.perf_counter() - start)
+        lms.disconnect()
+    return summary(times)
+
+
+def bench_discovery(discovery_port, rounds):
+    times = []
+    found = 0
+    discoverer = LMSDiscoverer(port=discovery_port)
+    for _i in range(rounds):
+        start = time.perf_counter()
+        servers = discoverer.discover_all()
+        times.append(time.perf_counter() - start)
+        found = max(found, len(servers))
+    res = summary(times)
+    res["servers"] = found
+    return res
+
+
+def bench_players(lms, rounds):
+    times = []
+    for _i in range(rounds):
+        start = time.perf_counter()
+        res = lms.players()
+        times.append(time.perf_counter() - start)
+    result = summary(times)
+    result["players"] = len(res)
+    return result
+
+
+def bench_status(lms, playerid, lines):
+    listener = BurstListener(playerid, lines)
+    lms.add_status_listener(listener)
+    lms.send("{} status - 1 tags:adKljJ subscribe:1".format(playerid))
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    lms.send("fakelms burst {} {}".format(playerid, lines))
+    if not listener.done.wait(60 + lines / 100):
+        logging.warning("last status update not received")
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    lms.remove_status_listener(listener)
+
+    res = summary(listener.latencies)
+    res["delivered"] = listener.received
+    res["lines_per_sec"] = lines / elapsed if elapsed else 0
+    res["cpu_ms_per_1000_lines"] = cpu / lines * 1000 * 1000
+    return res
+
+
+def bench_status_mpris(lms, playerid, lines):
+    """
+    Like bench_status, timed until LMSWrapper would emit
+    PropertiesChanged, including metadata handling
+    """
+    from lmsmpris import LMSWrapper
+
+    wrapper = LMSWrapper(config_file="/nonexistent/squeezelite.json")
+    wrapper.lms = lms
+    wrapper.playerid = playerid
+    listener = PropertiesListener(wrapper, lines)
+    wrapper.dbus_service = listener
+    wrapper.subscribe()
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    lms.send("fakelms burst {} {}".format(playerid, lines))
+    if not listener.done.wait(60 + lines / 100):
+        logging.warning("last PropertiesChanged not received")
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    lms.remove_status_listener(wrapper)
+
+    res = summary(listener.latencies)
+    res["signals"] = listener.signals
+    res["lines_per_sec"] = lines / elapsed if elapsed else 0
+    res["cpu_ms_per_1000_lines"] = cpu / lines * 1000 * 1000
+    return res
+
+
+def bench_status_cometd(lms, playerid, lines):
+    """
+    Like bench_status, with the status delivered over cometd
+    """
+    from cometd import CometdSubscriber
+    subscriber = CometdSubscriber(lms.host, lms.http_port)
+    listener = BurstListener(playerid, lines)
+    subscriber.subscribe(playerid, "adKljJ")
+    subscriber.start()
+    subscriber.add_status_listener(listener)
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    lms.send("fakelms burst {} {}".format(playerid, lines))
+    if not listener.done.wait(60 + lines / 100):
+        logging.warning("last status update not received")
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    subscriber.disconnect()
+
+    res = summary(listener.latencies)
+    res["delivered"] = listener.received
+    res["lines_per_sec"] = lines / elapsed if elapsed else 0
+    res["cpu_ms_per_1000_lines"] = cpu / lines * 1000 * 1000
+    return res
+
+
+def bench_playlist(lms, playerid, tracks, rounds, http=False):
+    times = []
+    for _i in range(rounds):
+        start = time.perf_counter()
+        if http:
+            lms.http().request(["status", 0, tracks, "tags:al"], playerid)
+        else:
+            lms.cmd_response("{} status 0 {} tags:al".format(playerid,
+                                                             tracks))
+        times.append(time.perf_counter() - start)
+    res = summary(times)
+    res["tracks"] = tracks
+    return res
+
+
+def bench_songinfo(lms, tracks, rounds):
+    """
+    Track details for a number of tracks in one call
+    """
+    times = []
+    for i in range(rounds):
+        track_ids = range(i * tracks + 1, (i + 1) * tracks + 1)
+        start = time.perf_counter()
+        lms.songinfo(track_ids, "aAlgtrudJKNx")
+        times.append(time.perf_counter() - start)
+    res = summary(times)
+    res["tracks"] = tracks
+    return res
+
+
+def soak_sample(wrapper, lines):
+    gc.collect()
+    sample = wrapper.selfcheck()
+    sample["lines"] = lines
+    return sample
+
+
+def soak(host, port, http_port, total, chunk, subscription="cli"):
+    """
+    Run total status lines through LMSWrapper.notify_status in bursts of
+    chunk lines, with a new connection for every burst. Returns the
+    selfcheck() samples taken after every burst.
+    """
+    from lmsmpris import LMSWrapper
+
+    wrapper = LMSWrapper(config_file="/nonexistent/squeezelite.json")
+    wrapper.config["subscription"] = subscription
+    lms = LMS(host=host, port=port, http_port=http_port)
+    lms.connect()
+    lms.cmd_response("fakelms players 1")
+    playerid = lms.players()[0]["playerid"]
+    lms.disconnect()
+
+    samples = []
+    sent = 0
+    while sent < total:
+        count = min(chunk, total - sent)
+        lms = LMS(host=host, port=port, http_port=http_port)
+        lms.connect()
+        wrapper.lms = lms
+        wrapper.playerid = playerid
+        lms.add_connection_listener(wrapper)
+        wrapper.subscribe()
+        # the last update of a burst carries its sequence number
+        done = BurstListener(playerid, count)
+        source = wrapper.subscriber or lms
+        source.add_status_listener(done)
+        lms.cmd_response("fakelms burst {} {}".format(playerid, count),
+                         timeout=60 + count / 100)
+        if not done.done.wait(60 + count / 100):
+            logging.warning("last status update not received")
+        source.remove_status_listener(done)
+        wrapper.drop_subscriber()
+        lms.remove_status_listener(wrapper)
+        lms.remove_connection_listener(wrapper)
+        lms.disconnect()
+        sent += count
+        samples.append(soak_sample(wrapper, sent))
+        logging.info("soak: %s lines, rss %.1f MB, %s objects", sent,
+                     samples[-1]["rss_bytes"] / 1e6,
+                     samples[-1]["gc_objects"])
+    return samples
+
+
+def soak_result(samples):
+    """
+    Growth between the first and the last sample. The first burst is
+    the baseline, it warms up caches and imports.
+    """
+    first = samples[0]
+    last = samples[-1]
+    res = {"lines": last["lines"],
+           "rss_mb": last["rss_bytes"] / 1e6,
+           "rss_growth_mb": (last["rss_bytes"] - first["rss_bytes"]) / 1e6}
+    for key in sorted(last):
+        if key not in ("lines", "rss_bytes"):
+            res[key + "_growth"] = last[key] - first.get(key, 0)
+    return res
+
+
+def run(args):
+    server = None
+    if args.server:
+        host, port = args.server.split(":")
+        port = int(port)
+        http_port = args.http_port
+        discovery_port = LMSDiscoverer.DISCOVERY_PORT
+    else:
+        server = FakeServerProcess(args.v)
+        host = "127.0.0.1"
+        port = server.port
+        http_port = server.http_port
+        discovery_port = server.discovery_port
+
+    results = {}
+    try:
+        if args.soak:
+            results["soak"] = soak_result(soak(
+                host, port, http_port, args.soak, args.soak_chunk,
+                args.subscription))
+            return results
+
+        results["connect"] = bench_connect(host, port, args.rounds)
+        if my_ips():
+            results["discovery"] = bench_discovery(discovery_port,
+                                                   min(args.rounds, 3))
+
+        lms = LMS(host=host, port=port, http_port=http_port)
+        lms.connect()
+        lms.cmd_response("fakelms players {}".format(args.players))
+        playerid = lms.players()[0]["playerid"]
+        lms.cmd_response("fakelms playlist {} {}".format(playerid,
+                                                         args.playlist))
+        results["players"] = bench_players(lms, args.rounds)
+        results["status"] = bench_status(lms, playerid, args.status_lines)
+        results["status_mpris"] = bench_status_mpris(lms, playerid,
+                                                     args.status_lines)
+        results["playlist"] = bench_playlist(lms, playerid, args.playlist,
+                                             args.rounds)
+        results["songinfo"] = bench_songinfo(lms, args.songinfo, args.rounds)
+        lms.disconnect()
+
+        if not args.no_http:
+            # the same calls over JSON-RPC
+            lms = LMS(host=host, port=port, http_port=http_port,
+                      http_calls=["players", "songinfo"])
+            lms.connect()
+            results["players_http"] = bench_players(lms, args.rounds)
+            results["status_cometd"] = bench_status_cometd(
+                lms, playerid, args.status_lines)
+            results["playlist_http"] = bench_playlist(lms, playerid,
+                                                      args.playlist,
+                                                      args.rounds, http=True)
+            results["songinfo_http"] = bench_songinfo(lms, args.songinfo,
+                                                      args.rounds)
+            lms.disconnect()
+    finally:
+        if server is not None:
+            server.stop()
+
+    return results
+
+
+def print_results(results):
+    for name, res in results.items():
+        values = ", ".join(
+            "{}={:.3f}".format(k, v) if isinstance(v, float)
+            else "{}={}".format(k, v)
+            for k, v in res.items())
+        print("{:<14} {}".format(name, values))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark lms.py against a (fake) LMS. "
+                    "Times are reported in ms.")
+    parser.add_argument("--server", metavar="HOST:PORT",
+                        help="use a running fakelms.py instead of "
+                        "starting one")
+    parser.add_argument("--http-port", type=int, default=9000,
+                        help="JSON-RPC port of the server given by --server")
+    parser.add_argument("--no-http", action="store_true",
+                        help="skip the JSON-RPC benchmarks")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--players", type=int, default=20,
+                        help="number of synthetic players")
+    parser.add_argument("--status-lines", type=int, default=5000)
+    parser.add_argument("--playlist", type=int, default=2000,
+                        help="number of tracks in the large playlist")
+    parser.add_argument("--songinfo", type=int, default=10,
+                        help="number of tracks per songinfo call")
+    parser.add_argument("--soak", type=int, default=0, metavar="LINES",
+                        help="run a memory soak test with LINES status "
+                        "updates instead of the benchmarks")
+    parser.add_argument("--soak-chunk", type=int, default=50000,
+                        help="status updates per connection in the soak test")
+    parser.add_argument("--subscription", choices=("cli", "cometd"),
+                        default="cli", help="status subscription used by "
+                        "the soak test")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    parser.add_argument("-v", action="store_true", help="verbose logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
+                        level=logging.DEBUG if args.v else logging.WARNING)
+    tracing.refresh()
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
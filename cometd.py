@@ -0,0 +1,197 @@
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# Player status subscriptions over LMS's cometd (Bayeux) interface
+#
+# A single long-polling HTTP channel delivers the status of all subscribed
+# players as JSON. Updates that arrive together are handed to the status
+# listeners in one go, so there is no per-line percent-decoding as with
+# the CLI subscription.
+#
+
+import http.client
+import json
+import logging
+import threading
+import time
+
+import metrics
+from jsonrpc import ConnectionPool
+from lms import Listeners, StatusQueue, json_to_dict
+
+MESSAGES = metrics.counter("cometd_messages_total",
+                           "Messages received over cometd")
+POLLS = metrics.counter("cometd_polls_total", "cometd long-poll requests")
+POLL_PARSE_TIME = metrics.histogram("cometd_poll_parse_seconds",
+                                    "Time to decode a cometd response")
+
+
+def json_status(data):
+    """
+    Flatten a JSON status result to the dictionary the CLI subscription
+    delivers: the fields of the current track are merged into the
+    player status
+    """
+    status = json_to_dict({tag: value for tag, value in data.items()
+                           if not isinstance(value, (list, dict))})
+    playlist = data.get("playlist_loop")
+    if playlist:
+        status.update(json_to_dict(playlist[0]))
+    return status
+
+
+class CometdSubscriber(threading.Thread):
+    """
+    Subscribes to player status updates using cometd
+
+    Provides the same listener interface as LMS: status listeners are
+    called with notify_status(playerid, status), connection listeners
+    with notify_disconnected(subscriber) when the channel breaks.
+    """
+
+    PATH = "/cometd"
+    # LMS holds a long-poll for up to 60 seconds
+    POLL_TIMEOUT = 90
+
+    def __init__(self, host, http_port=9000):
+        super().__init__(daemon=True)
+        self.host = host
+        self.http_port = int(http_port)
+        self.pool = ConnectionPool(host, self.http_port, 2,
+                                   CometdSubscriber.POLL_TIMEOUT)
+        self.client_id = None
+        self.running = False
+        self.status_listeners = Listeners()
+        self.status_queue = StatusQueue(self.status_listeners)
+        self.connection_listeners = Listeners()
+
+    def add_status_listener(self, listener):
+        self.status_listeners.add(listener)
+
+    def remove_status_listener(self, listener):
+        self.status_listeners.remove(listener)
+
+    def add_connection_listener(self, listener):
+        self.connection_listeners.add(listener)
+
+    def remove_connection_listener(self, listener):
+        self.connection_listeners.remove(listener)
+
+    def post(self, messages):
+        data = self.pool.post(CometdSubscriber.PATH,
+                              json.dumps(messages).encode())
+        return json.loads(data.decode())
+
+    def handshake(self):
+        res = self.post([{"channel": "/meta/handshake",
+                          "version": "1.0",
+                          "supportedConnectionTypes": ["long-polling"]}])
+        for message in res:
+            if message.get("channel") == "/meta/handshake" and \
+                    message.get("successful"):
+                self.client_id = message["clientId"]
+                return
+        raise IOError("cometd handshake with {} failed".format(self.host))
+
+    def channel(self, playerid):
+        return "/{}/slim/playerstatus/{}".format(self.client_id, playerid)
+
+    def subscribe(self, playerid, tags, interval=1):
+        """
+        Subscribe to the status of a player, with the same tags and
+        interval as a CLI status subscription
+        """
+        if self.client_id is None:
+            self.handshake()
+        command = ["status", "-", 1, "tags:{}".format(tags),
+                   "subscribe:{}".format(interval)]
+        self.post([{"channel": "/slim/subscribe",
+                    "clientId": self.client_id,
+                    "data": {"request": [playerid, command],
+                             "response": self.channel(playerid)}}])
+
+    def unsubscribe(self, playerid):
+        self.post([{"channel": "/slim/unsubscribe",
+                    "clientId": self.client_id,
+                    "data": {"unsubscribe": self.channel(playerid)}}])
+
+    def start(self):
+        if self.client_id is None:
+            self.handshake()
+        self.running = True
+        super().start()
+
+    def run(self):
+        prefix = "/{}/slim/playerstatus/".format(self.client_id)
+        try:
+            while self.running:
+                POLLS.inc()
+                data = self.pool.post(CometdSubscriber.PATH, json.dumps(
+                    [{"channel": "/meta/connect",
+                      "clientId": self.client_id,
+                      "connectionType": "long-polling"}]).encode())
+                start = time.perf_counter()
+                messages = json.loads(data.decode())
+                if not isinstance(messages, list):
+                    raise ValueError("unexpected cometd response {!r:.200}"
+                                     .format(messages))
+                updates = []
+                for message in messages:
+                    if not isinstance(message, dict):
+                        continue
+                    channel = message.get("channel", "")
+                    if channel == "/meta/connect":
+                        if not message.get("successful"):
+                            raise IOError("cometd connect rejected: {}".format(
+                                message.get("error")))
+                    elif channel.startswith(prefix) and \
+                            isinstance(message.get("data"), dict):
+                        updates.append((channel[len(prefix):],
+                                        json_status(message["data"])))
+                POLL_PARSE_TIME.observe(time.perf_counter() - start)
+                MESSAGES.inc(len(messages))
+
+                for playerid, status in updates:
+                    self.status_queue.put(playerid, status)
+        except (IOError, ValueError, http.client.HTTPException) as e:
+            if self.running:
+                logging.warning("cometd connection to %s failed: %s",
+                                self.host, e)
+        except Exception as e:
+            logging.error("cometd subscriber for %s died: %s", self.host, e)
+        finally:
+            self.running = False
+            self.status_queue.close()
+            self.pool.close()
+            for listener in self.connection_listeners:
+                listener.notify_disconnected(self)
+
+    def is_connected(self):
+        return self.running
+
+    def disconnect(self):
+        self.running = False
+        self.pool.close()
+
+    def __str__(self):
+        return "cometd/{}:{}".format(self.host, self.http_port)
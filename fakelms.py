@@ -0,0 +1,649 @@
+#!/usr/bin/env python3
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# A local stand-in for a Logitech Media Server.
+#
+# It implements the small subset of the CLI (port 9090), of the JSON-RPC
+# and cometd interfaces (port 9000) and of the UDP discovery protocol
+# (port 3483) that lms.py uses, can replay recorded
+# sessions and can generate synthetic load. Besides the LMS commands it
+# understands a few control commands in the "fakelms" namespace, so a
+# client running in another process can drive it over the CLI:
+#
+#   fakelms players <count>               add synthetic players
+#   fakelms playlist <playerid> <count>   give a player a large playlist
+#   fakelms burst <playerid> <count>      push <count> status updates
+#   fakelms replay <path> [speed]         replay a recorded session
+#
+
+import argparse
+import json
+import logging
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import quote
+
+
+def lms_encode(s):
+    return quote(str(s), safe="")
+
+
+def encode_line(parts):
+    return " ".join(lms_encode(part) for part in parts)
+
+
+class FakeLMSHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.server.lms.add_client(self)
+
+    def handle(self):
+        buffer = b""
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                line = line.decode().rstrip("\r")
+                if line:
+                    self.server.lms.handle_command(self, line)
+
+    def finish(self):
+        self.server.lms.remove_client(self)
+
+    def send_line(self, line):
+        with self.lock:
+            try:
+                self.request.sendall((line + "\n").encode())
+            except OSError:
+                pass
+
+
+class FakeLMSServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FakeHTTPHandler(BaseHTTPRequestHandler):
+
+    # keep-alive
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        # headers and body are written separately
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
+
+    def do_POST(self):
+        if self.path not in ("/jsonrpc.js", "/cometd"):
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length).decode())
+        except ValueError:
+            self.send_error(400)
+            return
+
+        lms = self.server.lms
+        if self.path == "/cometd":
+            response = lms.cometd_response(request)
+        elif isinstance(request, list):
+            if not lms.json_batches:
+                self.send_error(400)
+                return
+            response = [lms.jsonrpc_response(message) for message in request]
+        else:
+            response = lms.jsonrpc_response(request)
+
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("http: " + format, *args)
+
+
+class FakeHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class CometdClient():
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        # playerid -> response channel
+        self.subscriptions = {}
+        self.messages = []
+        self.condition = threading.Condition()
+
+    def deliver(self, message):
+        with self.condition:
+            self.messages.append(message)
+            self.condition.notify()
+
+    def poll(self, timeout):
+        with self.condition:
+            if not self.messages:
+                self.condition.wait(timeout)
+            messages = self.messages
+            self.messages = []
+        return messages
+
+
+class FakeLMS():
+    """
+    CLI and discovery stand-in for a Logitech Media Server
+    """
+
+    def __init__(self, host="", port=9090, discovery_port=3483,
+                 http_port=9000, name="FakeLMS", version="8.5.1",
+                 server_uuid=None):
+        self.host = host
+        self.port = port
+        self.discovery_port = discovery_port
+        self.http_port = http_port
+        self.name = name
+        self.version = version
+        self.uuid = server_uuid or str(uuid.uuid4())
+        self.players = []
+        self.clients = []
+        self.songinfo_requests = 0
+        self.http_requests = 0
+        self.cometd_clients = {}
+        # how long a cometd long-poll is held without updates
+        self.poll_timeout = 30
+        # answer JSON-RPC batch requests, real LMS versions might not
+        self.json_batches = True
+        self.lock = threading.Lock()
+        self.server = None
+        self.http_server = None
+        self.discovery_socket = None
+
+    def start(self):
+        self.server = FakeLMSServer((self.host, self.port), FakeLMSHandler)
+        self.server.lms = self
+        # port 0 lets the OS pick a free port
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        logging.info("CLI listening on port %s", self.port)
+
+        if self.http_port is not None:
+            self.http_server = FakeHTTPServer((self.host, self.http_port),
+                                              FakeHTTPHandler)
+            self.http_server.lms = self
+            self.http_port = self.http_server.server_address[1]
+            threading.Thread(target=self.http_server.serve_forever,
+                             daemon=True).start()
+            logging.info("JSON-RPC listening on port %s", self.http_port)
+
+        if self.discovery_port is not None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.bind(("", self.discovery_port))
+            self.discovery_port = sock.getsockname()[1]
+            self.discovery_socket = sock
+            threading.Thread(target=self.answer_discovery,
+                             daemon=True).start()
+            logging.info("discovery listening on port %s",
+                         self.discovery_port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+        for client in list(self.clients):
+            try:
+                client.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.discovery_socket is not None:
+            sock = self.discovery_socket
+            self.discovery_socket = None
+            sock.close()
+
+    # Discovery
+
+    def discovery_response(self, request):
+        values = {
+            "NAME": self.name,
+            "JSON": str(self.http_port),
+            "VERS": self.version,
+            "UUID": self.uuid,
+        }
+        res = b"E"
+        pos = 1
+        while pos + 5 <= len(request):
+            tag = request[pos:pos + 4].decode(errors="replace")
+            length = request[pos + 4]
+            pos += 5 + length
+            if tag in values:
+                val = values[tag].encode()[:255]
+                res += tag.encode() + bytes([len(val)]) + val
+        return res
+
+    def answer_discovery(self):
+        while self.discovery_socket is not None:
+            try:
+                data, addr = self.discovery_socket.recvfrom(1024)
+            except OSError:
+                break
+            if data[:1] == b"e":
+                logging.debug("discovery request from %s", addr)
+                self.discovery_socket.sendto(self.discovery_response(data),
+                                             addr)
+
+    # Players and load generation
+
+    def add_player(self, playerid, ip, name=None, status=None):
+        player = {
+            "playerid": playerid,
+            "ip": ip,
+            "name": name or "Player {}".format(len(self.players)),
+            "status": status or {"mode": "stop"},
+            "playlist": [],
+        }
+        with self.lock:
+            self.players.append(player)
+        return player
+
+    def add_synthetic_players(self, count, ip="10.0.0.1"):
+        start = len(self.players)
+        for i in range(start, start + count):
+            playerid = "02:00:00:{:02x}:{:02x}:{:02x}".format(
+                (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            self.add_player(playerid, "{}:{}".format(ip, 40000 + i % 20000))
+
+    def player(self, playerid):
+        for player in self.players:
+            if player["playerid"] == playerid:
+                return player
+
+    def set_playlist(self, playerid, count):
+        self.player(playerid)["playlist"] = [
+            {"id": i + 1,
+             "title": "Track {}".format(i + 1),
+             "artist": "Artist {}".format(i % 50),
+             "album": "Album {}".format(i % 200)}
+            for i in range(count)]
+
+    def synthetic_status(self, seq):
+        return {
+            "mode": "play",
+            "time": "{:.3f}".format(seq % 300 + 0.5),
+            "duration": "300.000",
+            "id": str(seq % 1000 + 1),
+            "title": "Track {}".format(seq % 1000 + 1),
+            "artist": "Artist {}".format(seq % 50),
+            "album": "Album {}".format(seq % 200),
+            "artwork_track_id": str(seq % 1000 + 1),
+        }
+
+    def status_parts(self, player, prefix, start=None, count=0):
+        parts = list(prefix)
+        parts += ["player_name:" + player["name"]]
+        parts += ["{}:{}".format(k, v) for k, v in player["status"].items()]
+        playlist = player["playlist"]
+        parts.append("playlist_tracks:{}".format(len(playlist)))
+        if start is not None:
+            for index in range(start, min(start + count, len(playlist))):
+                parts.append("playlist index:{}".format(index))
+                parts += ["{}:{}".format(k, v)
+                          for k, v in playlist[index].items()]
+        return parts
+
+    def push_status(self, playerid, status=None, extra=None):
+        """
+        Update the status of a player and send it to all subscribed clients
+        """
+        player = self.player(playerid)
+        if status:
+            player["status"].update(status)
+        for client in list(self.clients):
+            prefix = client.subscriptions.get(playerid)
+            if prefix is not None:
+                parts = self.status_parts(player, prefix)
+                if extra:
+                    parts += ["{}:{}".format(k, v) for k, v in extra.items()]
+                client.send_line(encode_line(parts))
+        for cometd_client in list(self.cometd_clients.values()):
+            channel = cometd_client.subscriptions.get(playerid)
+            if channel is not None:
+                data = self.status_json(player)
+                if extra:
+                    data.update(extra)
+                cometd_client.deliver({"channel": channel, "data": data})
+
+    def burst(self, playerid, count):
+        """
+        Push count status updates as fast as possible. Every update carries
+        a sequence number and a CLOCK_MONOTONIC timestamp, so clients can
+        measure delivery latency.
+        """
+        for seq in range(count):
+            self.push_status(playerid, self.synthetic_status(seq),
+                             extra={"bench_seq": seq,
+                                    "bench_ts": repr(time.monotonic())})
+
+    def replay(self, path, speed=None):
+        """
+        Send the lines of a recorded session to all clients.
+
+        Lines may be prefixed by a timestamp in seconds and a tab. With
+        speed=None lines are sent as fast as possible, otherwise the
+        recorded timing is reproduced, scaled by speed.
+        """
+        from tracing import read_capture
+        last_ts = None
+        for ts, line in read_capture(path):
+            if speed and ts is not None and last_ts is not None:
+                time.sleep(max(0, ts - last_ts) / speed)
+            last_ts = ts
+            for client in list(self.clients):
+                client.send_line(line)
+
+    # CLI
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.append(client)
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.remove(client)
+
+    def handle_command(self, client, line):
+        from lms import lms_decode
+        parts = [lms_decode(p) for p in line.split(" ")]
+        logging.debug("got %s", parts)
+
+        if parts[0] == "fakelms":
+            self.handle_control(client, parts)
+            return
+
+        if parts[0] == "players" and len(parts) >= 3:
+            client.send_line(encode_line(self.players_response(parts)))
+        elif parts[0] == "songinfo":
+            client.send_line(encode_line(self.songinfo_response(parts)))
+        elif parts[0] == "version":
+            client.send_line(encode_line(["version", self.version]))
+        elif len(parts) > 1 and parts[1] == "status":
+            self.status_command(client, parts)
+        else:
+            # LMS acknowledges commands by echoing them
+            client.send_line(line)
+
+    def players_response(self, parts):
+        start = int(parts[1])
+        count = int(parts[2])
+        res = parts[:3] + ["count:{}".format(len(self.players))]
+        for index in range(start, min(start + count, len(self.players))):
+            player = self.players[index]
+            res += ["playerindex:{}".format(index),
+                    "playerid:" + player["playerid"],
+                    "ip:" + player["ip"],
+                    "name:" + player["name"],
+                    "model:squeezelite",
+                    "connected:1"]
+        return res
+
+    def track(self, track_id):
+        """
+        Track data for an id, from a playlist or synthetic
+        """
+        for player in self.players:
+            for track in player["playlist"]:
+                if str(track["id"]) == str(track_id):
+                    return dict(track)
+        n = int(track_id)
+        return {"id": n,
+                "title": "Track {}".format(n),
+                "artist": "Artist {}".format(n % 50),
+                "album": "Album {}".format(n % 200),
+                "genre": "Genre {}".format(n % 10),
+                "tracknum": n % 20 + 1,
+                "duration": "300.000",
+                "bitrate": "320kbps CBR",
+                "url": "file:///music/{}.flac".format(n),
+                "artwork_track_id": n}
+
+    def songinfo_response(self, parts):
+        self.songinfo_requests += 1
+        track_id = None
+        for part in parts:
+            if part.startswith("track_id:"):
+                track_id = part.split(":", 1)[1]
+        res = list(parts)
+        if track_id is not None:
+            res += ["{}:{}".format(k, v)
+                    for k, v in self.track(track_id).items()]
+        return res
+
+    def status_command(self, client, parts):
+        player = self.player(parts[0])
+        if player is None:
+            client.send_line(encode_line(parts))
+            return
+        if "subscribe:1" in parts:
+            client.subscriptions[parts[0]] = parts
+        elif "subscribe:0" in parts:
+            client.subscriptions.pop(parts[0], None)
+
+        start = None
+        count = 0
+        if len(parts) > 3 and parts[2] != "-":
+            start = int(parts[2])
+            count = int(parts[3])
+        client.send_line(encode_line(
+            self.status_parts(player, parts, start, count)))
+
+    # JSON-RPC
+
+    def jsonrpc_response(self, message):
+        self.http_requests += 1
+        playerid, command = message["params"]
+        return {"id": message.get("id"),
+                "method": message.get("method"),
+                "params": message["params"],
+                "result": self.jsonrpc_result(playerid, command)}
+
+    def jsonrpc_result(self, playerid, command):
+        command = [str(part) for part in command]
+        name = command[0]
+        if name == "players":
+            start = int(command[1])
+            count = int(command[2])
+            return {"count": len(self.players),
+                    "players_loop": [
+                        {"playerindex": str(index),
+                         "playerid": player["playerid"],
+                         "ip": player["ip"],
+                         "name": player["name"],
+                         "model": "squeezelite",
+                         "connected": 1}
+                        for index, player in enumerate(self.players)
+                        if start <= index < start + count]}
+        elif name == "songinfo":
+            self.songinfo_requests += 1
+            for part in command:
+                if part.startswith("track_id:"):
+                    track = self.track(part.split(":", 1)[1])
+                    return {"songinfo_loop": [{k: v}
+                                              for k, v in track.items()]}
+            return {"songinfo_loop": []}
+        elif name == "status":
+            player = self.player(playerid)
+            if player is None:
+                return {}
+            res = dict(player["status"], player_name=player["name"])
+            playlist = player["playlist"]
+            res["playlist_tracks"] = len(playlist)
+            if len(command) > 2 and command[1] != "-":
+                start = int(command[1])
+                count = int(command[2])
+                res["playlist_loop"] = [
+                    dict(track, **{"playlist index": index})
+                    for index, track in enumerate(playlist)
+                    if start <= index < start + count]
+            return res
+        elif name == "serverstatus":
+            return {"version": self.version,
+                    "player count": len(self.players)}
+        return {}
+
+    # cometd
+
+    # fields that LMS reports per track in the playlist loop
+    TRACK_FIELDS = ("id", "title", "artist", "album", "duration",
+                    "artwork_track_id", "artwork_url", "remote_title")
+
+    def status_json(self, player):
+        res = {"player_name": player["name"],
+               "playlist_tracks": len(player["playlist"])}
+        track = {"playlist index": 0}
+        for k, v in player["status"].items():
+            if k in FakeLMS.TRACK_FIELDS:
+                track[k] = v
+            else:
+                res[k] = v
+        res["playlist_loop"] = [track]
+        return res
+
+    def cometd_response(self, messages):
+        res = []
+        for message in messages:
+            channel = message.get("channel")
+            client = self.cometd_clients.get(message.get("clientId"))
+            if channel == "/meta/handshake":
+                client_id = uuid.uuid4().hex[:8]
+                self.cometd_clients[client_id] = CometdClient(client_id)
+                res.append({"channel": channel, "successful": True,
+                            "clientId": client_id, "version": "1.0",
+                            "advice": {"reconnect": "retry",
+                                       "interval": 0,
+                                       "timeout": self.poll_timeout * 1000}})
+            elif client is None:
+                res.append({"channel": channel, "successful": False,
+                            "error": "402::Unknown client",
+                            "advice": {"reconnect": "handshake"}})
+            elif channel == "/meta/connect":
+                res.append({"channel": channel, "successful": True,
+                            "clientId": client.client_id})
+                res += client.poll(self.poll_timeout)
+            elif channel == "/slim/subscribe":
+                playerid, _command = message["data"]["request"]
+                player = self.player(playerid)
+                client.subscriptions[playerid] = message["data"]["response"]
+                res.append({"channel": channel, "successful": True,
+                            "clientId": client.client_id})
+                if player is not None:
+                    client.deliver({"channel": message["data"]["response"],
+                                    "data": self.status_json(player)})
+            elif channel == "/slim/unsubscribe":
+                response = message["data"]["unsubscribe"]
+                for playerid, subscribed in list(
+                        client.subscriptions.items()):
+                    if subscribed == response:
+                        del client.subscriptions[playerid]
+                res.append({"channel": channel, "successful": True,
+                            "clientId": client.client_id})
+        return res
+
+    def handle_control(self, client, parts):
+        cmd = parts[1] if len(parts) > 1 else None
+        if cmd == "players":
+            self.add_synthetic_players(int(parts[2]))
+        elif cmd == "playlist":
+            self.set_playlist(parts[2], int(parts[3]))
+        elif cmd == "burst":
+            self.burst(parts[2], int(parts[3]))
+        elif cmd == "replay":
+            speed = float(parts[3]) if len(parts) > 3 else None
+            self.replay(parts[2], speed)
+        else:
+            logging.warning("unknown control command %s", parts)
+        client.send_line(encode_line(parts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Logitech Media Server")
+    parser.add_argument("--host", default="")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--discovery-port", type=int, default=3483)
+    parser.add_argument("--http-port", type=int, default=9000)
+    parser.add_argument("--players", type=int, default=0,
+                        help="number of synthetic players")
+    parser.add_argument("--player", action="append", default=[],
+                        metavar="PLAYERID=IP",
+                        help="add a player with the given IP address")
+    parser.add_argument("--replay", help="replay a recorded session "
+                        "to every client that connects")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="replay speed (default: as fast as possible)")
+    parser.add_argument("-v", action="store_true", help="verbose logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
+                        level=logging.DEBUG if args.v else logging.INFO)
+
+    fake = FakeLMS(host=args.host, port=args.port,
+                   discovery_port=args.discovery_port,
+                   http_port=args.http_port)
+    for spec in args.player:
+        playerid, ip = spec.split("=", 1)
+        fake.add_player(playerid, ip + ":40000")
+    fake.add_synthetic_players(args.players)
+    fake.start()
+
+    try:
+        while True:
+            if args.replay and fake.clients:
+                fake.replay(args.replay, args.speed)
+                args.replay = None
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        fake.stop()
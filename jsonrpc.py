@@ -0,0 +1,208 @@
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# LMS JSON-RPC transport (http://<server>:9000/jsonrpc.js)
+#
+# Requests use the same commands as the CLI, but results are structured
+# JSON, which is much cheaper to parse for large results like playlists
+# or player lists than the percent-encoded CLI tokens. HTTP connections
+# are kept alive and reused.
+#
+
+import http.client
+import itertools
+import json
+import logging
+import queue
+import socket
+import time
+
+import metrics
+
+HTTP_RTT = metrics.histogram("jsonrpc_request_seconds",
+                             "Round trip time of JSON-RPC requests")
+HTTP_ERRORS = metrics.counter("jsonrpc_errors_total",
+                              "Failed JSON-RPC requests")
+HTTP_CONNECTS = metrics.counter("jsonrpc_connections_total",
+                                "HTTP connections opened")
+
+
+class JSONRPCError(IOError):
+    pass
+
+
+class ConnectionPool():
+    """
+    Keep-alive HTTP connections to a single server.
+
+    At most size connections are kept open, more can be used
+    concurrently but are closed after the request. close() also aborts
+    requests that are still running, e.g. long-polls.
+    """
+
+    def __init__(self, host, port, size=2, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(size)
+        self.busy = set()
+        self.closed = False
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            HTTP_CONNECTS.inc()
+            return http.client.HTTPConnection(self.host, self.port,
+                                              timeout=self.timeout)
+
+    def put(self, connection):
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def post(self, path, body):
+        """
+        POST a body and return the response body. A request on a kept
+        alive connection that the server has closed in the meantime is
+        retried once on a new connection.
+        """
+        headers = {"Content-Type": "application/json"}
+        for attempt in (0, 1):
+            if self.closed:
+                raise IOError("connection pool closed")
+            connection = self.get()
+            reused = connection.sock is not None
+            self.busy.add(connection)
+            try:
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            finally:
+                self.busy.discard(connection)
+            if response.will_close or self.closed:
+                connection.close()
+            else:
+                self.put(connection)
+            if response.status != 200:
+                raise JSONRPCError("HTTP {} from {}:{}".format(
+                    response.status, self.host, self.port))
+            return data
+
+    def close(self):
+        self.closed = True
+        for connection in list(self.busy):
+            sock = connection.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class LMSJSONRPC():
+    """
+    slim.request calls over HTTP
+
+    A command is given as a list like on the CLI, e.g.
+    ["players", 0, 100], results are returned as dictionaries.
+    """
+
+    PATH = "/jsonrpc.js"
+
+    def __init__(self, host, port=9000, pool_size=2, timeout=10):
+        self.host = host
+        self.port = port
+        self.pool = ConnectionPool(host, port, pool_size, timeout)
+        self.ids = itertools.count(1)
+        # cleared if the server doesn't understand batch requests
+        self.batching = True
+
+    def message(self, command, playerid=None):
+        return {"id": next(self.ids),
+                "method": "slim.request",
+                "params": [playerid or "", list(command)]}
+
+    def call(self, body):
+        start = time.perf_counter()
+        try:
+            data = self.pool.post(LMSJSONRPC.PATH, json.dumps(body).encode())
+            res = json.loads(data.decode())
+        except (IOError, ValueError, http.client.HTTPException) as e:
+            HTTP_ERRORS.inc()
+            raise JSONRPCError("JSON-RPC request to {}:{} failed: {}".format(
+                self.host, self.port, e))
+        HTTP_RTT.observe(time.perf_counter() - start)
+        return res
+
+    @staticmethod
+    def result(response):
+        if not isinstance(response, dict) or "result" not in response:
+            HTTP_ERRORS.inc()
+            raise JSONRPCError("invalid JSON-RPC response {!r:.200}".format(
+                response))
+        return response["result"]
+
+    def request(self, command, playerid=None):
+        return self.result(self.call(self.message(command, playerid)))
+
+    def batch(self, requests):
+        """
+        Run a list of (command, playerid) requests, using a single HTTP
+        request if the server supports JSON-RPC batches. Results are
+        returned in the order of the requests.
+        """
+        messages = [self.message(command, playerid)
+                    for command, playerid in requests]
+        if self.batching and len(messages) > 1:
+            try:
+                responses = self.call(messages)
+            except JSONRPCError as e:
+                logging.debug("batch request failed: %s", e)
+                responses = None
+            if isinstance(responses, list):
+                by_id = {response.get("id"): response
+                         for response in responses
+                         if isinstance(response, dict)}
+                return [self.result(by_id.get(message["id"]))
+                        for message in messages]
+            logging.info("%s:%s doesn't support batch requests",
+                         self.host, self.port)
+            self.batching = False
+
+        # one by one over the same kept alive connection
+        return [self.result(self.call(message)) for message in messages]
+
+    def close(self):
+        self.pool.close()
@@ -20,9 +20,82 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
+import collections
 import logging
 import threading
 import socket
+import struct
+import time
+import weakref
+
+import metrics
+import tracing
+from tracing import TRACE
+
+LINES = metrics.counter("lms_lines_total", "Lines received from LMS")
+BYTES = metrics.counter("lms_received_bytes_total",
+                        "Bytes received from LMS")
+PARSE_TIME = metrics.histogram("lms_line_parse_seconds",
+                               "Time to decode a line from LMS")
+DISPATCH_TIME = metrics.histogram("lms_line_dispatch_seconds",
+                                  "Time spent dispatching a line on the "
+                                  "reader thread")
+COMMAND_RTT = metrics.histogram("lms_command_rtt_seconds",
+                                "Round trip time of CLI commands")
+COMMAND_TIMEOUTS = metrics.counter("lms_command_timeouts_total",
+                                   "CLI commands without response")
+STATUS_COLLAPSED = metrics.counter("lms_status_collapsed_total",
+                                   "Status updates replaced by a newer one "
+                                   "before listeners saw them")
+DISCOVERY_TIME = metrics.histogram("lms_discovery_seconds",
+                                   "Duration of a discovery run")
+DISCOVERY_RESPONSES = metrics.counter("lms_discovery_responses_total",
+                                      "Discovery responses received")
+
+
+class Listeners():
+    """
+    Registered listeners, held by weak references
+
+    A listener that is garbage collected drops out by itself and adding
+    the same listener again has no effect, so failed connection attempts
+    and reconnects can't make the list grow. Iterating returns a
+    snapshot, listeners can be removed while being notified.
+    """
+
+    def __init__(self):
+        self.refs = []
+        # re-entrant, the garbage collector may call discard() while
+        # this thread holds the lock
+        self.lock = threading.RLock()
+
+    def add(self, listener):
+        with self.lock:
+            for ref in self.refs:
+                if ref() is listener:
+                    return
+            self.refs.append(weakref.ref(listener, self.discard))
+
+    def remove(self, listener):
+        with self.lock:
+            self.refs = [ref for ref in self.refs
+                         if ref() is not listener and ref() is not None]
+
+    def discard(self, ref):
+        with self.lock:
+            self.refs = [r for r in self.refs if r is not ref]
+
+    def clear(self):
+        with self.lock:
+            self.refs = []
+
+    def __iter__(self):
+        listeners = [ref() for ref in self.refs]
+        return iter([listener for listener in listeners
+                     if listener is not None])
+
+    def __len__(self):
+        return len(self.refs)
 
 
 def lms_decode(s):
@@ -43,23 +116,68 @@ def lms_decode(s):
     return res
 
 
+def parse_line(line):
+    """
+    Decode a line received from LMS. Returns the decoded parts and, for
+    status lines, a dict of the tags (otherwise None).
+    """
+    parts = []
+    status = {}
+    i = 0
+    is_status = False
+    for p in line.split(" "):
+        part = lms_decode(p)
+        if i == 1 and p == "status":
+            is_status = True
+        i += 1
+
+        # automatically split status into a dict
+        if is_status and ":" in part:
+            [tag, content] = part.split(":", 1)
+            status[tag] = content
+
+        parts.append(part)
+
+    return parts, status if is_status else None
+
+
+def songinfo_to_dict(parts):
+    """
+    Track details from a songinfo response
+    """
+    info = {}
+    # skip the echoed command
+    for part in parts[5:]:
+        if ":" in part:
+            [tag, content] = part.split(":", 1)
+            # the first value wins if a tag is repeated
+            info.setdefault(tag, content)
+    return info
+
+
 def response_to_dict(parts):
     if parts is None:
         return {}
 
+    # parts are already decoded by LMS.listen
     res = {}
     for part in parts:
-        part = lms_decode(part)
         if ":" in part:
             [tag, content] = part.split(":", 1)
             res[tag] = content
     return res
 
 
-def local_networks():
+def json_to_dict(item):
     """
-    Return my IPs. Needed to check if this client is connected to
-    a specific LMS
+    JSON-RPC results have typed values, the CLI only knows strings
+    """
+    return {tag: str(value) for tag, value in item.items()}
+
+
+def read_local_networks():
+    """
+    Enumerate the IPv4 addresses of all interfaces
     """
     from netifaces import interfaces, ifaddresses, AF_INET
     netlist = []
@@ -70,6 +188,121 @@ def local_networks():
     return netlist
 
 
+class NetworkMonitor():
+    """
+    Cached list of local networks
+
+    Interfaces are only re-enumerated when the cache is older than ttl
+    seconds or when the kernel reports an address change via netlink.
+    Listeners are notified via notify_networks(ips) only if the set of
+    (non-loopback) addresses really changed.
+    """
+
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTM_NEWADDR = 20
+    RTM_DELADDR = 21
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.netlist = None
+        self.updated = 0
+        self.listeners = Listeners()
+        self.lock = threading.Lock()
+        self.netlink = None
+
+    def networks(self):
+        if self.netlist is None or time.monotonic() - self.updated > self.ttl:
+            self.refresh()
+        return self.netlist
+
+    def refresh(self):
+        self.set_networks(read_local_networks())
+
+    def set_networks(self, netlist):
+        """
+        Replace the cached networks, e.g. with a synthetic list for tests
+        """
+        with self.lock:
+            old_ips = self.ips(self.netlist)
+            self.netlist = netlist
+            self.updated = time.monotonic()
+            new_ips = self.ips(netlist)
+
+        if old_ips is not None and old_ips != new_ips:
+            logging.info("local addresses changed from %s to %s",
+                         sorted(old_ips), sorted(new_ips))
+            for listener in self.listeners:
+                listener.notify_networks(sorted(new_ips))
+
+    @staticmethod
+    def ips(netlist):
+        if netlist is None:
+            return None
+        return set(net["addr"] for net in netlist
+                   if not net["addr"].startswith("127."))
+
+    def add_listener(self, listener):
+        self.listeners.add(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def start(self):
+        """
+        Listen for address changes. Without netlink support (non-Linux
+        systems), the cache is only refreshed after the TTL expired.
+        """
+        if self.netlink is not None:
+            return
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 socket.NETLINK_ROUTE)
+            sock.bind((0, NetworkMonitor.RTMGRP_IPV4_IFADDR))
+        except (AttributeError, OSError) as e:
+            logging.info("can't monitor address changes: %s", e)
+            return
+        self.netlink = sock
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        while self.netlink is not None:
+            try:
+                data = self.netlink.recv(65536)
+            except OSError:
+                break
+
+            changed = False
+            pos = 0
+            while pos + 16 <= len(data):
+                length, msgtype = struct.unpack_from("=IH", data, pos)
+                if msgtype in (NetworkMonitor.RTM_NEWADDR,
+                               NetworkMonitor.RTM_DELADDR):
+                    changed = True
+                if length < 16:
+                    break
+                pos += (length + 3) & ~3
+
+            if changed:
+                self.refresh()
+
+    def stop(self):
+        sock = self.netlink
+        self.netlink = None
+        if sock is not None:
+            sock.close()
+
+
+NETWORKS = NetworkMonitor()
+
+
+def local_networks():
+    """
+    Return my IPs. Needed to check if this client is connected to
+    a specific LMS
+    """
+    return NETWORKS.networks()
+
+
 def my_ips():
     res = []
     for net in local_networks():
@@ -84,6 +317,101 @@ def broadcast(ip):
             return net["broadcast"]
 
 
+# Translate LMS's TLV tag names to easier to read names
+DISCOVERY_TAGS = {
+    'NAME': 'name',
+    'IPAD': 'host',
+    'JSON': 'http_port',
+    'VERS': 'version',
+    'UUID': 'uuid',
+}
+
+
+def parse_discovery_response(data):
+    """
+    Parse a TLV discovery response, based on LMS perl implementation:
+    https://github.com/LMS-Community/slimserver/blob/8.5.1/Slim/Networking/Discovery/Server.pm#L182
+    https://github.com/LMS-Community/slimserver/blob/8.5.1/Slim/Networking/Discovery.pm#L153
+
+    The length byte counts bytes, so values are decoded one by one. Unknown
+    tags are kept under their lower case name, a truncated last entry is
+    ignored. Returns None if this isn't a discovery response.
+    """
+    view = memoryview(data)
+    end = len(view)
+    if end == 0 or view[0] != 0x45:  # 'E'
+        return None
+
+    server = {}
+    pos = 1
+    while pos + 5 <= end:
+        tag = bytes(view[pos:pos + 4]).decode("ascii", "replace")
+        length = view[pos + 4]
+        pos += 5
+        if pos + length > end:
+            break
+        if length > 0:
+            name = DISCOVERY_TAGS.get(tag, tag.lower())
+            server[name] = bytes(view[pos:pos + length]).decode("utf-8",
+                                                                "replace")
+        pos += length
+    return server
+
+
+class ServerRegistry():
+    """
+    All LMS servers that have been seen, keyed by UUID (or IP address
+    for servers that don't report a UUID)
+    """
+
+    # the least recently seen servers are dropped beyond this
+    MAX_SERVERS = 32
+
+    def __init__(self):
+        self.servers = {}
+        self.lock = threading.Lock()
+        # set while a DiscoveryListener keeps the registry up to date
+        self.listening = False
+
+    def update(self, server):
+        key = server.get("uuid") or server["host"]
+        entry = dict(server)
+        entry["last_seen"] = time.monotonic()
+        with self.lock:
+            known = self.servers.pop(key, None)
+            self.servers[key] = entry
+            while len(self.servers) > ServerRegistry.MAX_SERVERS:
+                # ordered by last update
+                del self.servers[next(iter(self.servers))]
+        if known is None:
+            logging.info("found LMS %s (%s, version %s)",
+                         server.get("name"), server["host"],
+                         server.get("version"))
+        elif known.get("version") != entry.get("version"):
+            logging.info("LMS %s is now running version %s",
+                         server.get("name"), server.get("version"))
+        return entry
+
+    def get(self, key):
+        return self.servers.get(key)
+
+    def list(self, max_age=None):
+        now = time.monotonic()
+        with self.lock:
+            return [dict(server) for server in self.servers.values()
+                    if max_age is None or now - server["last_seen"] <= max_age]
+
+    def prune(self, max_age):
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, server in self.servers.items()
+                        if now - server["last_seen"] > max_age]:
+                del self.servers[key]
+
+
+SERVERS = ServerRegistry()
+
+
 class LMSDiscoverer():
     """
     derived from https://pastebin.com/5jfta04x
@@ -91,21 +419,23 @@ class LMSDiscoverer():
 
     DISCOVERY_PORT = 3483
     TIMEOUT_MS = 2500
-    DISCOVERY_PACKET = b"eIPAD\0NAME\0JSON\0VERS\0"
+    DISCOVERY_PACKET = b"eIPAD\0NAME\0JSON\0VERS\0UUID\0"
+    DISCOVERY_TAGS = DISCOVERY_TAGS
 
-    # Translate LMS's TLV tag names to easier to read names
-    DISCOVERY_TAGS = {
-        'NAME': 'name',
-        'IPAD': 'host',
-        'JSON': 'http_port',
-        'VERS': 'version',
-        'UUID': 'uuid',
-    }
+    # Servers seen by a DiscoveryListener within this time are used
+    # without sending a new discovery packet
+    MAX_AGE = 120
 
-    def __init__(self):
-        pass
+    def __init__(self, port=DISCOVERY_PORT, registry=SERVERS):
+        self.port = port
+        self.registry = registry
 
     def discover_all(self):
+        if self.registry.listening:
+            servers = self.registry.list(max_age=LMSDiscoverer.MAX_AGE)
+            if servers:
+                return servers
+
         # Use a dict keyed by server IP address to deduplicate servers
         servers = {}
         for ip in my_ips():
@@ -116,6 +446,27 @@ class LMSDiscoverer():
         return servers
 
     def discover(self, source_address):
+        with DISCOVERY_TIME.time():
+            return self._discover(source_address)
+
+    def handle_response(self, data, ip):
+        logging.debug("received message from %s: %s", ip, data)
+        DISCOVERY_RESPONSES.inc()
+
+        server = parse_discovery_response(data)
+        if not server:
+            return None
+
+        # We've parsed a useful response...
+        if "host" not in server:
+            # ...but didn't get an IP address
+            # (LMS only returns the IP address if it's explicitly set by the server
+            # admin, otherwise we're supposed to use the discovery packet IP)
+            server["host"] = ip
+        logging.debug("Parsed server discovery response: %s", server)
+        return self.registry.update(server)
+
+    def _discover(self, source_address):
         servers = {}
 
         client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
@@ -127,43 +478,18 @@ class LMSDiscoverer():
                       LMSDiscoverer.DISCOVERY_PACKET)
         try:
             client.sendto(LMSDiscoverer.DISCOVERY_PACKET,
-                          ('<broadcast>', LMSDiscoverer.DISCOVERY_PORT))
+                          ('<broadcast>', self.port))
         except OSError:
             # The interface might not support broadcasts
-            return []
+            client.close()
+            return {}
 
         while True:
             try:
                 data, (ip, _port) = client.recvfrom(1024)
-                logging.debug("received message from %s: %s", ip, data)
-
-                # Parse discovery response, based on LMS perl implementation:
-                # https://github.com/LMS-Community/slimserver/blob/8.5.1/Slim/Networking/Discovery/Server.pm#L182
-                # https://github.com/LMS-Community/slimserver/blob/8.5.1/Slim/Networking/Discovery.pm#L153
-                msg = data.decode()
-                if msg[0] == 'E':
-                    msg = msg[1:] # drop leading E
-
-                    server = {}
-                    remaining = len(msg)
-                    while remaining > 0:
-                        tag = msg[0:4]
-                        length = ord(msg[4])
-                        val = msg[5:5+length] if length > 0 else None
-                        if val:
-                            server[LMSDiscoverer.DISCOVERY_TAGS[tag]] = val
-                        msg = msg[5+length:]
-                        remaining = remaining - 5 - length
-
-                    if server:
-                        # We've parsed a useful response...
-                        if "host" not in server:
-                            # ...but didn't get an IP address
-                            # (LMS only returns the IP address if it's explicitly set by the server
-                            # admin, otherwise we're supposed to use the discovery packet IP)
-                            server["host"] = ip
-                        servers[ip] = server
-                        logging.debug("Parsed server discovery response: %s", server)
+                server = self.handle_response(data, ip)
+                if server:
+                    servers[ip] = server
 
             except socket.timeout:
                 break
@@ -194,6 +520,86 @@ class LMSDiscoverer():
         return result
 
 
+class DiscoveryListener(threading.Thread):
+    """
+    Keeps the server registry up to date in the background
+
+    Listens on the discovery port for unsolicited announcements and
+    collects responses to a discovery packet that is broadcast every
+    interval seconds (and whenever the local addresses change) from a
+    single long-lived socket. LMS.connect() then finds servers in the
+    registry without waiting for discovery responses.
+    """
+
+    def __init__(self, interval=60, port=LMSDiscoverer.DISCOVERY_PORT,
+                 registry=SERVERS):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.port = port
+        self.discoverer = LMSDiscoverer(port, registry)
+        self.registry = registry
+        self.running = False
+        self.refresh_now = threading.Event()
+
+    def notify_networks(self, _ips):
+        self.refresh_now.set()
+
+    def open_sockets(self):
+        sockets = []
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        client.bind(("", 0))
+        sockets.append(client)
+
+        announcements = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        announcements.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            announcements.bind(("", self.port))
+            sockets.append(announcements)
+        except OSError as e:
+            logging.info("can't listen for LMS announcements: %s", e)
+            announcements.close()
+
+        return sockets
+
+    def run(self):
+        import select
+
+        sockets = self.open_sockets()
+        client = sockets[0]
+        self.running = True
+        self.registry.listening = True
+        NETWORKS.add_listener(self)
+        next_broadcast = 0
+        try:
+            while self.running:
+                now = time.monotonic()
+                if now >= next_broadcast or self.refresh_now.is_set():
+                    self.refresh_now.clear()
+                    # servers that missed several broadcasts are gone
+                    self.registry.prune(3 * self.interval)
+                    try:
+                        client.sendto(LMSDiscoverer.DISCOVERY_PACKET,
+                                      ('<broadcast>', self.port))
+                    except OSError as e:
+                        logging.debug("can't send discovery packet: %s", e)
+                    next_broadcast = now + self.interval
+
+                readable, _w, _x = select.select(sockets, [], [], 1)
+                for sock in readable:
+                    data, (ip, _port) = sock.recvfrom(1024)
+                    self.discoverer.handle_response(data, ip)
+        finally:
+            self.registry.listening = False
+            NETWORKS.remove_listener(self)
+            for sock in sockets:
+                sock.close()
+
+    def stop(self):
+        self.running = False
+
+
 class StatusDisplay():
 
     def __init__(self):
@@ -206,62 +612,141 @@ class StatusDisplay():
         pass
 
 
-class CommandResponseListener(threading.Thread):
+class StatusQueue():
+    """
+    Hands status updates from the reader thread to the status listeners.
 
-    def __init__(self, lmslistener, cmdline, timeout):
-        threading.Thread.__init__(self)
-        self.lmslistener = lmslistener
-        self.cmdline = cmdline
-        self.parts = cmdline.split(" ")
-        self.timeout = timeout
-        self.lock = threading.Lock()
-        self.result = None
+    There is one slot per player that only holds the latest status. The
+    reader never blocks on slow listeners: if a player's status changes
+    again before the listeners have seen the previous one, the older
+    one is dropped. LMS always sends the full status, so nothing is
+    lost except intermediate states.
+    """
 
-    def notify_line(self, parts):
+    def __init__(self, listeners):
+        self.listeners = listeners
+        self.slots = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.worker = None
+        self.closed = False
+
+    def put(self, playerid, status):
+        with self.condition:
+            if playerid in self.slots:
+                STATUS_COLLAPSED.inc()
+            self.slots[playerid] = status
+            if self.worker is None:
+                self.closed = False
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+            self.condition.notify()
 
-        # Check if this is a reponse to the given command
-        if len(parts) < len(self.parts):
-            return
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.slots:
+                    if self.closed:
+                        self.worker = None
+                        return
+                    self.condition.wait()
+                playerid, status = self.slots.popitem(last=False)
+
+            for listener in self.listeners:
+                try:
+                    listener.notify_status(playerid, status)
+                except Exception as e:
+                    logging.exception("status listener %s failed: %s",
+                                      listener, e)
+
+    def close(self):
+        """
+        Let the worker exit once the remaining updates are delivered
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def __len__(self):
+        return len(self.slots)
+
+
+class CommandTimeout(IOError):
+    pass
 
+
+class PendingResponse():
+    """
+    Response to a command that has been sent to LMS
+
+    The reader thread hands the matching line over via notify_line(),
+    waiting is done on an Event in the thread that sent the command.
+    No thread is created per command.
+    """
+
+    def __init__(self, cmdline):
+        self.cmdline = cmdline
+        self.parts = cmdline.split(" ")
+        self.event = threading.Event()
+        self.parts_received = None
+        self.error = None
+        self.sent = time.perf_counter()
+
+    def matches(self, parts):
         # answer should start with the full command string
+        if len(parts) < len(self.parts):
+            return False
         for i in range(0, len(self.parts)):
             if self.parts[i] != parts[i]:
-                return
+                return False
+        return True
 
+    def notify_line(self, parts):
         # Ok, this is an answer to our request, store it and release
+        self.parts_received = parts
+        self.event.set()
 
-        self.result = parts
-        self.lock.release()
-
-    def run(self):
-        if not(self.lock.acquire(self.timeout)):
-            logging.info("timeout waitung for response to %s",
-                         self.commandline)
+    def cancel(self, error=None):
+        self.error = error or IOError("command {} cancelled".format(
+            self.cmdline))
+        self.event.set()
 
-    def read_response(self):
-        if not(self.lock.acquire(blocking=False)):
-            logging.error("internal error: can't get lock")
+    def done(self):
+        return self.event.is_set()
 
-        self.lmslistener.add_line_listener(self)
-        self.start()
-        self.lmslistener.send(self.cmdline)
-        self.join()
-        self.lmslistener.remove_line_listener(self)
-        return self.result
+    def result(self, timeout=None):
+        """
+        Wait for the response, raises CommandTimeout if there was none
+        within timeout seconds and IOError if the request was cancelled
+        """
+        if not self.event.wait(timeout):
+            raise CommandTimeout("timeout waiting for response to {}".format(
+                self.cmdline))
+        if self.error is not None:
+            raise self.error
+        return self.parts_received
 
 
 class LMS():
 
-    def __init__(self, host=None, port=9090, http_port=9000, find_my_server=False, **kwargs):
+    def __init__(self, host=None, port=9090, http_port=9000, find_my_server=False,
+                 http_calls=None, **kwargs):
         self.host = host
         self.port = port
         self.http_port = http_port
         self.find_my_server = find_my_server
+        # calls that use JSON-RPC over HTTP instead of the CLI,
+        # status subscriptions always use the CLI
+        self.http_calls = set(http_calls or [])
+        self.jsonrpc = None
         self.socket = None
-        self.status_listeners = []
-        self.line_listeners = []
-
-    def connect(self):
+        self.status_listeners = Listeners()
+        self.status_queue = StatusQueue(self.status_listeners)
+        self.line_listeners = Listeners()
+        self.connection_listeners = Listeners()
+        self.pending = []
+        self.pending_lock = threading.Lock()
+
+    def connect(self, timeout=None):
         """
         - find LMS server
         - check if the
@@ -296,25 +781,56 @@ class LMS():
                 self.http_port = my_lms.get("http_port", self.http_port)
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.host, self.port))
+        sock.settimeout(timeout)
+        try:
+            sock.connect((self.host, self.port))
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        # commands are small, don't let pipelined ones wait for ACKs
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.socket = sock
         reader = threading.Thread(target=self.listen)
         reader.start()
 
     def disconnect(self):
         logging.debug("disconnecting from server")
-        socket = self.socket
+        sock = self.socket
         self.socket = None
-        socket.close()
+        # the reader thread may have closed the socket already
+        if sock is not None:
+            try:
+                # wakes up the reader thread
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        if self.jsonrpc is not None:
+            self.jsonrpc.close()
+            self.jsonrpc = None
+
+    # Listeners are held by weak references, the caller has to keep
+    # a reference to them
 
     def add_status_listener(self, listener):
-        self.status_listeners.append(listener)
+        self.status_listeners.add(listener)
 
     def remove_status_listener(self, listener):
         self.status_listeners.remove(listener)
 
+    def add_connection_listener(self, listener):
+        """
+        listener.notify_disconnected(lms) is called when the connection
+        to the server is lost
+        """
+        self.connection_listeners.add(listener)
+
+    def remove_connection_listener(self, listener):
+        self.connection_listeners.remove(listener)
+
     def add_line_listener(self, listener):
-        self.line_listeners.append(listener)
+        self.line_listeners.add(listener)
 
     def remove_line_listener(self, listener):
         self.line_listeners.remove(listener)
@@ -340,17 +856,95 @@ class LMS():
             logging.warn("LMS socket not connected, ignoring command")
             return
 
+        commandline = command
         if not(command.endswith("\n")):
             commandline = command + "\n"
 
         self.socket.sendall(commandline.encode())
-        logging.debug("sent %s", command)
+        TRACE.record(TRACE.SENT, command)
+        if tracing.DEBUG:
+            logging.debug("sent %s", command)
+
+    def request(self, command):
+        """
+        Send a command, returns a PendingResponse for its response
+        """
+        if self.socket is None:
+            raise IOError("LMS socket not connected")
+        pending = PendingResponse(command)
+        with self.pending_lock:
+            self.pending.append(pending)
+        try:
+            self.send(command)
+        except Exception:
+            self.discard(pending)
+            raise
+        return pending
+
+    def discard(self, pending):
+        with self.pending_lock:
+            if pending in self.pending:
+                self.pending.remove(pending)
 
     def cmd_response(self, command, timeout=10):
-        return CommandResponseListener(self, command, timeout).read_response()
+        return self.cmd_responses([command], timeout)[0]
+
+    def cmd_responses(self, commands, timeout=10):
+        """
+        Send several commands without waiting for the responses in
+        between, returns the responses in the same order
+        """
+        requests = []
+        try:
+            for command in commands:
+                requests.append(self.request(command))
+            res = []
+            deadline = time.monotonic() + timeout
+            for pending in requests:
+                try:
+                    res.append(pending.result(
+                        max(0, deadline - time.monotonic())))
+                except CommandTimeout:
+                    COMMAND_TIMEOUTS.inc()
+                    raise
+                COMMAND_RTT.observe(time.perf_counter() - pending.sent)
+            return res
+        finally:
+            for pending in requests:
+                self.discard(pending)
+
+    def uses_http(self, call):
+        return call in self.http_calls
+
+    def http(self):
+        """
+        JSON-RPC connection to this server, created on first use
+        """
+        if self.jsonrpc is None:
+            from jsonrpc import LMSJSONRPC
+            self.jsonrpc = LMSJSONRPC(self.host, int(self.http_port))
+        return self.jsonrpc
+
+    def dispatch_response(self, parts):
+        with self.pending_lock:
+            for pending in self.pending:
+                if pending.matches(parts):
+                    self.pending.remove(pending)
+                    break
+            else:
+                return
+        pending.notify_line(parts)
+
+    def cancel_pending(self, error):
+        with self.pending_lock:
+            pending = self.pending
+            self.pending = []
+        for response in pending:
+            response.cancel(error)
 
     def listen(self):
-        if self.socket is None:
+        sock = self.socket
+        if sock is None:
             logging.warn("LMS socket not connected")
             return
 
@@ -360,9 +954,10 @@ class LMS():
                 if "\n" in buffer:
                     line = buffer
                 else:
-                    data = self.socket.recv(1024)
+                    data = sock.recv(1024)
                     if not data:
                         break
+                    BYTES.inc(len(data))
                     line = buffer + data.decode()
 
                 buffer = ""
@@ -371,49 +966,62 @@ class LMS():
                 if lf == -1:
                     # Got no full line, waiting for more data
                     buffer = line
+                    continue
                 elif lf < len(line) - 1:
                     buffer = line[lf + 1:]
                     line = line[:lf]
                 else:
                     line = line[:-1]
 
-                parts = []
-                status = {}
-                i = 0
-                is_status = False
-                for p in line.split(" "):
-                    part = lms_decode(p)
-                    if i == 1 and p == "status":
-                        is_status = True
-                    i += 1
+                LINES.inc()
+                TRACE.record(TRACE.RECEIVED, line)
+                if tracing.CAPTURE is not None:
+                    tracing.CAPTURE.write(line)
+                start = time.perf_counter()
+
+                parts, status = parse_line(line)
 
-                    # automatically split status into a dict
-                    if is_status and ":" in part:
-                        [tag, content] = part.split(":", 1)
-                        status[tag] = content
+                parsed = time.perf_counter()
+                PARSE_TIME.observe(parsed - start)
 
-                    parts.append(part)
+                # responses first, they must not wait for status listeners
+                if self.pending:
+                    self.dispatch_response(parts)
 
-                if is_status:
-                    for listener in self.status_listeners:
-                        listener.notify_status(parts[0], status)
+                if status is not None and self.status_listeners:
+                    self.status_queue.put(parts[0], status)
 
                 for listener in self.line_listeners:
                     listener.notify_line(parts)
 
-                logging.debug("got %s from LMS", line)
+                DISPATCH_TIME.observe(time.perf_counter() - parsed)
+
+                if tracing.DEBUG:
+                    logging.debug("got %s from LMS", line)
 
         except IOError as e:
             if self.socket is not None:
                 logging.warn("I/O error, connection probably closed, %s",
                               e)
 
-        self.socket = None
+        if self.socket is sock:
+            self.socket = None
+        sock.close()
+        self.cancel_pending(IOError("connection to LMS closed"))
+        self.status_queue.close()
+
+        for listener in self.connection_listeners:
+            listener.notify_disconnected(self)
 
     def is_connected(self):
         return self.socket is not None
 
     def players(self):
+        if self.uses_http("players"):
+            result = self.http().request(["players", 0, 999])
+            return [json_to_dict(player)
+                    for player in result.get("players_loop", [])]
+
         index = 0
         res = []
         while True:
@@ -438,6 +1046,34 @@ class LMS():
             if ip in iplist:
                 return player
 
+    def songinfo(self, track_ids, tags):
+        """
+        Track details for a list of track ids. Returns a dictionary
+        for every track, in the same order.
+        """
+        if self.uses_http("songinfo"):
+            results = self.http().batch(
+                [(["songinfo", 0, 100, "track_id:{}".format(track_id),
+                   "tags:{}".format(tags)], None)
+                 for track_id in track_ids])
+            res = []
+            for result in results:
+                info = {}
+                for item in result.get("songinfo_loop", []):
+                    for tag, value in item.items():
+                        info.setdefault(tag, str(value))
+                res.append(info)
+            return res
+
+        responses = self.cmd_responses(
+            ["songinfo 0 100 track_id:{} tags:{}".format(track_id, tags)
+             for track_id in track_ids])
+        return [songinfo_to_dict(parts) for parts in responses]
+
+    def server_info(self):
+        return {"host": self.host, "port": self.port,
+                "http_port": self.http_port}
+
     def cover_url(self, artwork_track_id):
         return "http://{}:{}/music/{}/cover.jpg".format(self.host,
                                                         self.http_port,
@@ -450,6 +1086,208 @@ class LMS():
             return "LMS/{}/not connected".format(self.host)
 
 
+class ServerPool():
+    """
+    Priority list of LMS servers
+
+    Servers are tried in the configured order, followed by discovered
+    servers. Servers that failed recently are moved to the end, servers
+    with the same priority are ordered by their CLI round trip time.
+    Optionally, a connection to the next best server is kept open as a
+    warm standby, so switching over doesn't need to connect first.
+    """
+
+    # Weight of a new RTT sample in the moving average
+    RTT_WEIGHT = 0.3
+    # Failures older than this don't count anymore
+    FAILURE_PENALTY = 60
+    CONNECT_TIMEOUT = 2
+    PROBE_TIMEOUT = 2
+    # discovered servers come and go, don't keep health data forever
+    MAX_HEALTH_ENTRIES = 64
+
+    def __init__(self, servers=None, discover=True, warm_standby=False,
+                 http_calls=None, **kwargs):
+        self.servers = list(servers or [])
+        self.discover = discover
+        self.warm_standby = warm_standby
+        self.http_calls = http_calls
+        self.health = {}
+        self.standby = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(server):
+        return "{}:{}".format(server["host"], server.get("port", 9090))
+
+    def candidates(self):
+        servers = list(self.servers)
+        if self.discover or not servers:
+            known = set(self.key(server) for server in servers)
+            for server in LMSDiscoverer().discover_all():
+                if self.key(server) not in known:
+                    known.add(self.key(server))
+                    servers.append(server)
+
+        priority = {self.key(server): i for i, server in enumerate(servers)}
+        return sorted(servers, key=lambda server: self.score(
+            server, priority[self.key(server)]))
+
+    def score(self, server, priority=0):
+        """
+        Lower is better
+        """
+        health = self.health.get(self.key(server), {})
+        failed = time.monotonic() - health.get("failed", -1e9) \
+            < ServerPool.FAILURE_PENALTY
+        # only discovered servers (same priority) are ordered by RTT
+        if priority >= len(self.servers):
+            priority = len(self.servers)
+        return (failed, priority, health.get("rtt", 0))
+
+    def server_health(self, server):
+        key = self.key(server)
+        health = self.health.get(key)
+        if health is None:
+            while len(self.health) >= ServerPool.MAX_HEALTH_ENTRIES:
+                del self.health[next(iter(self.health))]
+            health = self.health[key] = {}
+        return health
+
+    def record_rtt(self, server, rtt):
+        health = self.server_health(server)
+        if "rtt" in health:
+            rtt = health["rtt"] + ServerPool.RTT_WEIGHT * (rtt - health["rtt"])
+        health["rtt"] = rtt
+
+    def record_failure(self, server):
+        self.server_health(server)["failed"] = time.monotonic()
+
+    def probe(self, lms):
+        """
+        Measure the CLI round trip time of a connected server
+        """
+        start = time.perf_counter()
+        lms.cmd_response("serverstatus 0 0", ServerPool.PROBE_TIMEOUT)
+        self.record_rtt(lms.server_info(), time.perf_counter() - start)
+
+    def open(self, server):
+        lms = LMS(host=server["host"], port=server.get("port", 9090),
+                  http_port=server.get("http_port", 9000),
+                  http_calls=self.http_calls)
+        try:
+            lms.connect(timeout=ServerPool.CONNECT_TIMEOUT)
+            self.probe(lms)
+        except Exception:
+            self.record_failure(server)
+            if lms.is_connected():
+                lms.disconnect()
+            raise
+        return lms
+
+    def take_standby(self):
+        with self.lock:
+            lms = self.standby
+            self.standby = None
+        if lms is not None and not lms.is_connected():
+            return None
+        return lms
+
+    def connect(self, iplist=None):
+        """
+        Connect to the best server our player is attached to.
+        Returns the connected LMS and the player.
+        """
+        if iplist is None:
+            iplist = my_ips()
+
+        skip = None
+        standby = self.take_standby()
+        if standby is not None:
+            skip = self.key(standby.server_info())
+            try:
+                me = standby.client(iplist)
+            except Exception as e:
+                logging.info("standby %s failed: %s", standby.host, e)
+                self.record_failure(standby.server_info())
+                standby.disconnect()
+            else:
+                if me is not None:
+                    logging.info("switched to standby server %s",
+                                 standby.host)
+                    return standby, me
+                # our player might not have moved over yet
+                with self.lock:
+                    self.standby = standby
+
+        for server in self.candidates():
+            if self.key(server) == skip:
+                continue
+            try:
+                lms = self.open(server)
+            except Exception as e:
+                logging.info("can't use LMS %s: %s", server["host"], e)
+                continue
+            try:
+                me = lms.client(iplist)
+            except Exception as e:
+                logging.info("can't list players on LMS %s: %s",
+                             server["host"], e)
+                self.record_failure(server)
+                lms.disconnect()
+                continue
+            if me is not None:
+                return lms, me
+            lms.disconnect()
+
+        raise IOError("player not found on any LMS")
+
+    def prepare_standby(self, active):
+        """
+        Connect to the best server other than the active one
+        """
+        if not self.warm_standby:
+            return
+        with self.lock:
+            if self.standby is not None and self.standby.is_connected():
+                return
+
+        for server in self.candidates():
+            if self.key(server) == self.key(active.server_info()):
+                continue
+            try:
+                lms = self.open(server)
+            except Exception as e:
+                logging.debug("standby %s not available: %s",
+                              server["host"], e)
+                continue
+            logging.info("standby connection to %s", lms.host)
+            with self.lock:
+                self.standby = lms
+            return
+
+    def check_standby(self):
+        """
+        Keep the RTT of the standby server up to date, drop it if it
+        doesn't respond
+        """
+        with self.lock:
+            lms = self.standby
+        if lms is None:
+            return
+        try:
+            self.probe(lms)
+        except Exception as e:
+            logging.info("standby %s failed: %s", lms.host, e)
+            self.record_failure(lms.server_info())
+            self.drop_standby()
+
+    def drop_standby(self):
+        lms = self.take_standby()
+        if lms is not None:
+            lms.disconnect()
+
+
 if __name__ == "__main__":
     lms = LMS(find_my_server=True)
     lms.connect()
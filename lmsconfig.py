@@ -0,0 +1,267 @@
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# Server configuration, read from the squeezelite config file:
+#
+# {
+#   "server": {"value": "lms.local", "port": 9090, "http_port": 9000},
+#   "fallback_servers": [{"value": "lms2.local"}],
+#   "discover": false,
+#   "warm_standby": true,
+#   "http_calls": ["players", "songinfo"],
+#   "subscription": "cometd"
+# }
+#
+# "server" is the primary server. "fallback_servers" are tried in the given
+# order if it fails. Discovered servers are used if no server is
+# configured, or after the configured ones if "discover" is true.
+# "warm_standby" keeps a connection to the next best server open.
+# "http_calls" lists the calls that use JSON-RPC over HTTP instead of the
+# CLI (players, songinfo).
+# "subscription" selects how player status updates are received: "cli"
+# (default) or "cometd", which uses JSON over HTTP.
+#
+
+import json
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+DEFAULT_CONFIG_FILE = '/etc/squeezelite.json'
+
+HTTP_CALLS = ("players", "songinfo")
+SUBSCRIPTIONS = ("cli", "cometd")
+
+
+def port_number(value):
+    port = int(value)
+    if not 0 < port < 65536:
+        raise ValueError("invalid port {}".format(value))
+    return port
+
+
+def server_entry(server):
+    """
+    Convert a {"value": ..., "port": ...} entry from the config file,
+    raises ValueError if the entry is invalid
+    """
+    if not isinstance(server, dict):
+        raise ValueError("invalid server entry {!r}".format(server))
+    host = server.get('value')
+    if not host:
+        return None
+    if not isinstance(host, str):
+        raise ValueError("invalid server address {!r}".format(host))
+    return {
+        "host": host.strip(),
+        "port": port_number(server.get('port', 9090)),
+        "http_port": port_number(server.get('http_port', 9000)),
+    }
+
+
+def http_calls(value):
+    if not isinstance(value, list):
+        raise ValueError("http_calls must be a list")
+    for call in value:
+        if call not in HTTP_CALLS:
+            raise ValueError("unsupported HTTP call {!r}".format(call))
+    return sorted(set(value))
+
+
+def subscription(value):
+    if value not in SUBSCRIPTIONS:
+        raise ValueError("unsupported subscription {!r}".format(value))
+    return value
+
+
+def parse_config(config_data):
+    servers = []
+    for entry in [config_data.get('server', {})] + \
+            list(config_data.get('fallback_servers', [])):
+        server = server_entry(entry)
+        if server is not None:
+            servers.append(server)
+
+    return {
+        "servers": servers,
+        "discover": bool(config_data.get('discover', not servers)),
+        "warm_standby": bool(config_data.get('warm_standby', False)),
+        "http_calls": http_calls(config_data.get('http_calls', [])),
+        "subscription": subscription(config_data.get('subscription', "cli")),
+    }
+
+
+def read_config(config_file=DEFAULT_CONFIG_FILE):
+    """
+    Read and validate the config file, raises ValueError if it is invalid
+    """
+    if not os.path.exists(config_file):
+        return parse_config({})
+
+    with open(config_file, 'r') as file:
+        config_data = json.load(file)
+    if not isinstance(config_data, dict):
+        raise ValueError("config file doesn't contain a JSON object")
+    try:
+        return parse_config(config_data)
+    except (TypeError, AttributeError) as e:
+        raise ValueError(str(e))
+
+
+def load_config(config_file=DEFAULT_CONFIG_FILE):
+    # Check if the config file exists
+    if not os.path.exists(config_file):
+        logging.info("Config file does not exist, trying to discover LMS")
+        return parse_config({})
+
+    try:
+        config = read_config(config_file)
+    except (OSError, ValueError) as e:
+        logging.error("Error reading the server configuration file: %s", e)
+        return parse_config({})
+
+    for i, server in enumerate(config["servers"]):
+        if i == 0:
+            logging.info("Using server %s from config file", server["host"])
+        else:
+            logging.info("Fallback server %s from config file",
+                         server["host"])
+    if not config["servers"]:
+        logging.info("No server configured, trying to discover LMS")
+
+    return config
+
+
+class ConfigWatcher(threading.Thread):
+    """
+    Watches the config file and calls listener.notify_config(config)
+    with the new, validated configuration when it changes.
+
+    Uses inotify on the directory, so editors that replace the file are
+    handled as well. Falls back to checking the modification time every
+    POLL_INTERVAL seconds if inotify is not available.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_CLOEXEC = 0o2000000
+
+    POLL_INTERVAL = 5
+    # Editors often write a file in several steps
+    SETTLE_TIME = 0.2
+
+    def __init__(self, listener, config, config_file=DEFAULT_CONFIG_FILE):
+        super().__init__(daemon=True)
+        self.listener = listener
+        self.config = config
+        self.config_file = config_file
+        self.running = True
+
+    def inotify_fd(self):
+        # ctypes is slow to import, only load it when the watcher starts
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(ConfigWatcher.IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logging.info("inotify not available: %s", e)
+            return None
+        if fd < 0:
+            return None
+
+        directory = os.path.dirname(os.path.abspath(self.config_file))
+        mask = ConfigWatcher.IN_CLOSE_WRITE | ConfigWatcher.IN_MOVED_TO | \
+            ConfigWatcher.IN_CREATE | ConfigWatcher.IN_DELETE | \
+            ConfigWatcher.IN_MODIFY
+        if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+            logging.info("can't watch %s: errno %s", directory,
+                         ctypes.get_errno())
+            os.close(fd)
+            return None
+        return fd
+
+    def names(self, data):
+        pos = 0
+        while pos + 16 <= len(data):
+            _wd, _mask, _cookie, length = struct.unpack_from("iIII", data, pos)
+            name = data[pos + 16:pos + 16 + length].rstrip(b"\0")
+            yield name.decode(errors="replace")
+            pos += 16 + length
+
+    def mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def run(self):
+        fd = self.inotify_fd()
+        filename = os.path.basename(self.config_file)
+        last_mtime = self.mtime()
+        while self.running:
+            if fd is not None:
+                readable, _w, _x = select.select([fd], [], [], 1)
+                if not readable:
+                    continue
+                if filename not in self.names(os.read(fd, 4096)):
+                    continue
+                time.sleep(ConfigWatcher.SETTLE_TIME)
+                # drop events caused by the same change
+                while select.select([fd], [], [], 0)[0]:
+                    os.read(fd, 4096)
+            else:
+                time.sleep(ConfigWatcher.POLL_INTERVAL)
+                mtime = self.mtime()
+                if mtime == last_mtime:
+                    continue
+                last_mtime = mtime
+            self.reload()
+
+        if fd is not None:
+            os.close(fd)
+
+    def reload(self):
+        try:
+            config = read_config(self.config_file)
+        except (OSError, ValueError) as e:
+            logging.error("ignoring invalid config file %s: %s",
+                          self.config_file, e)
+            return
+
+        if config == self.config:
+            return
+        logging.info("config file changed, servers: %s",
+                     [server["host"] for server in config["servers"]]
+                     or "discovery")
+        self.config = config
+        self.listener.notify_config(config)
+
+    def stop(self):
+        self.running = False
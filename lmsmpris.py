@@ -31,226 +31,400 @@
 from __future__ import print_function
 
 import sys
-import dbus.service
-from dbus.mainloop.glib import DBusGMainLoop
+import gc
 import logging
 import time
 import threading
 import math
-import json
-import os
-
-from lms import LMS
-
-try:
-    from gi.repository import GLib
-    using_gi_glib = True
-except ImportError:
-    import glib as GLib
-
-identity = "LMS client"
-
-# python dbus bindings don't include annotations and properties
-MPRIS2_INTROSPECTION = """<node name="/org/mpris/MediaPlayer2">
-  <interface name="org.freedesktop.DBus.Introspectable">
-    <method name="Introspect">
-      <arg direction="out" name="xml_data" type="s"/>
-    </method>
-  </interface>
-  <interface name="org.freedesktop.DBus.Properties">
-    <method name="Get">
-      <arg direction="in" name="interface_name" type="s"/>
-      <arg direction="in" name="property_name" type="s"/>
-      <arg direction="out" name="value" type="v"/>
-    </method>
-    <method name="GetAll">
-      <arg direction="in" name="interface_name" type="s"/>
-      <arg direction="out" name="properties" type="a{sv}"/>
-    </method>
-    <method name="Set">
-      <arg direction="in" name="interface_name" type="s"/>
-      <arg direction="in" name="property_name" type="s"/>
-      <arg direction="in" name="value" type="v"/>
-    </method>
-    <signal name="PropertiesChanged">
-      <arg name="interface_name" type="s"/>
-      <arg name="changed_properties" type="a{sv}"/>
-      <arg name="invalidated_properties" type="as"/>
-    </signal>
-  </interface>
-  <interface name="org.mpris.MediaPlayer2">
-    <method name="Raise"/>
-    <method name="Quit"/>
-    <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
-    <property name="CanQuit" type="b" access="read"/>
-    <property name="CanRaise" type="b" access="read"/>
-    <property name="HasTrackList" type="b" access="read"/>
-    <property name="Identity" type="s" access="read"/>
-    <property name="DesktopEntry" type="s" access="read"/>
-    <property name="SupportedUriSchemes" type="as" access="read"/>
-    <property name="SupportedMimeTypes" type="as" access="read"/>
-  </interface>
-  <interface name="org.mpris.MediaPlayer2.Player">
-    <method name="Next"/>
-    <method name="Previous"/>
-    <method name="Pause"/>
-    <method name="PlayPause"/>
-    <method name="Stop"/>
-    <method name="Play"/>
-    <method name="Seek">
-      <arg direction="in" name="Offset" type="x"/>
-    </method>
-    <method name="SetPosition">
-      <arg direction="in" name="TrackId" type="o"/>
-      <arg direction="in" name="Position" type="x"/>
-    </method>
-    <method name="OpenUri">
-      <arg direction="in" name="Uri" type="s"/>
-    </method>
-    <signal name="Seeked">
-      <arg name="Position" type="x"/>
-    </signal>
-    <property name="PlaybackStatus" type="s" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="LoopStatus" type="s" access="readwrite">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="Rate" type="d" access="readwrite">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="Shuffle" type="b" access="readwrite">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="Metadata" type="a{sv}" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="Volume" type="d" access="readwrite">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
-    </property>
-    <property name="Position" type="x" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
-    </property>
-    <property name="MinimumRate" type="d" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="MaximumRate" type="d" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="CanGoNext" type="b" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="CanGoPrevious" type="b" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="CanPlay" type="b" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="CanPause" type="b" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="CanSeek" type="b" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
-    </property>
-    <property name="CanControl" type="b" access="read">
-      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
-    </property>
-  </interface>
-</node>"""
+
+import lmsconfig
+import metrics
+import tracing
+from lms import LMS, NETWORKS, SERVERS, DiscoveryListener, ServerPool
+from metadata import MetadataEnricher, STATUS_TAGS, build_metadata
+from playstate import DEFAULT_STATE_FILE, PlaybackStateWriter
+from sdnotify import SystemdNotifier, watchdog_interval
+
+RECONNECTS = metrics.counter("reconnects_total",
+                             "Connection attempts after a failure")
+DOWNTIME = metrics.counter("downtime_seconds_total",
+                           "Time without a working LMS connection")
 
 
 class LMSWrapper(threading.Thread):
     """ Wrapper to handle all communications with LMS
     """
 
-    def __init__(self, config_file='/etc/squeezelite.json'):
-        super().__init__()
+    # Retry interval while switching to a standby server
+    FAILOVER_DELAY = 0.5
+    FAILOVER_RETRIES = 10
+    MAX_DELAY = 600
+    # run() reports progress at least this often unless it is waiting
+    # before a reconnect, connecting includes discovery and probing
+    PROGRESS_TIMEOUT = 60
+
+    def __init__(self, config_file=lmsconfig.DEFAULT_CONFIG_FILE):
+        super().__init__(daemon=True)
 
         # Initialize default settings
-        server_info = {'find_my_server': True}
         self.playerid = None
         self.playback_status = "unknown"
         self.metadata = {}
+        self.track_id = None
+        self.track_info = None
+        self.last_lms_status = {}
+        self.metadata_lock = threading.Lock()
+        self.enricher = MetadataEnricher(self)
         self.dbus_service = None
-        self.bus = dbus.SessionBus()
+        # playback state in shared memory, see playstate.py
+        self.state_writer = None
         self.received_data = False
-
-        # Check if the config file exists
-        if os.path.exists(config_file):
-            try:
-                with open(config_file, 'r') as file:
-                    config_data = json.load(file)
-                # Extract the server address from the nested structure
-                server = config_data.get('server', {})
-                server_address = server.get('value')
-                if server_address:
-                    logging.info("Using server %s from config file")
-                    server_port = server.get('port', 9090)
-                    server_http_port = server.get('http_port', 9000)
-                    self.lms = LMS(host=server_address, port=server_port, http_port=server_http_port)
-                else:
-                    # If the server address is not found, fall back to automatic discovery
-                    self.lms = LMS(find_my_server=True)
-            except json.JSONDecodeError:
-                print("Error reading the server configuration file.")
-                self.lms = LMS(find_my_server=True)
-        else:
-            logging.info("Config file does not exist, trying to discover LMS")
-            self.lms = LMS(find_my_server=True)
-
+        # interrupts waiting in run(), e.g. after a network change
+        self.wakeup = threading.Event()
+        # reconnect without back-off, e.g. after a network change
+        self.reconnect_now = False
+        # (pool, config, lms, me) prepared after the config changed, lms
+        # is None if the server stays the same or isn't reachable yet
+        self.migration = None
+        self.migration_lock = threading.Lock()
+        self.next_config = None
+        self.migrator = None
+        self.discovery_listener = None
+        # cometd status subscription, None if the CLI is used
+        self.subscriber = None
+        self.disconnected_since = time.monotonic()
+        # for the health check: the thread is alive and not stuck
+        self.last_progress = time.monotonic()
+        self.progress_timeout = LMSWrapper.PROGRESS_TIMEOUT
+        self.last_status_time = None
+        self.retry_at = None
+        # reconnect attempts since the last successful connection
+        self.failovers = 0
+        self.backoff = 0
+
+        metrics.gauge("lms_status_queue_depth",
+                      "Players with a status update waiting for delivery",
+                      function=lambda: len(
+                          (self.subscriber or self.lms).status_queue))
+        metrics.gauge("metadata_queue_depth",
+                      "Tracks waiting for a songinfo request",
+                      function=lambda: self.enricher.requests.qsize())
+        metrics.gauge("process_resident_memory_bytes",
+                      "Resident memory size", function=metrics.rss_bytes)
+        metrics.gauge("process_threads", "Running threads",
+                      function=threading.active_count)
+
+        self.config_file = config_file
+        self.config = lmsconfig.load_config(config_file)
+        self.pool = ServerPool(**self.config)
+        # replaced by a connected instance in run()
+        self.lms = LMS()
 
     def run(self):
-        MAX_DELAY = 600
         try:
-            error_count = 0
-            self.dbus_service = MPRISInterface()
+            NETWORKS.add_listener(self)
+            NETWORKS.start()
+            self.start_discovery()
+            lmsconfig.ConfigWatcher(self, self.config,
+                                    self.config_file).start()
 
             while True:
+                active = None
+                self.progress()
                 try:
-                    self.lms.connect()
-                    me = self.lms.client()
-                    if me is None:
-                        logging.info(
-                            "could not find myself as a client, aborting")
-                        self.lms.disconnect()
-                        break
+                    active, me = self.take_migration()
+                    if active is None:
+                        active, me = self.pool.connect()
+                    self.lms = active
 
                     logging.info("connected to LMS server at %s", self.lms.host)
 
-                    error_count = 0
+                    self.failovers = 0
+                    self.backoff = 0
+                    DOWNTIME.inc(time.monotonic() - self.disconnected_since)
+                    self.disconnected_since = None
 
                     self.playerid = me["playerid"]
                     logging.info("%s, playerid=%s", self.lms, self.playerid)
 
-                    # subscribe to player status updates
-                    self.lms.add_status_listener(self)
-                    self.lms.send(
-                        "{} status - 1 tags:adKljJ subscribe:1".format(self.playerid))
+                    self.lms.add_connection_listener(self)
+                    self.subscribe()
+
+                    self.pool.prepare_standby(self.lms)
 
-                    while self.lms.is_connected():
+                    while self.lms.is_connected() and \
+                            (self.subscriber is None or
+                             self.subscriber.is_connected()):
                         self.received_data = False
-                        time.sleep(10)
+                        self.progress()
+                        if self.wakeup.wait(10):
+                            break
                         if not(self.received_data):
                             logging.warning(
                                 "did not receive status updated from LMS, re-connecting")
                             break
+                        self.take_migration(config_only=True)
+                        self.pool.check_standby()
+                        self.pool.prepare_standby(self.lms)
 
                 except Exception as e:
                     logging.warning("error communicating with LMS: %s", e)
-                    error_count += 1
-
-                # Wait a bit before reconnecting
-                delaytime = math.pow(2, error_count)
-                if (delaytime > MAX_DELAY):
-                    delaytime = MAX_DELAY
 
-                logging.info("waiting %s seconds before trying to reconnect",
-                             delaytime)
-                time.sleep(delaytime)
+                # a broken cometd channel doesn't mean the server is bad
+                subscriber_failed = self.subscriber is not None and \
+                    not self.subscriber.is_connected() and \
+                    active is not None and active.is_connected()
+                self.drop_subscriber()
+                if active is not None:
+                    active.remove_status_listener(self)
+                    active.remove_connection_listener(self)
+                    if not self.reconnect_now and not subscriber_failed:
+                        self.pool.record_failure(active.server_info())
+                    if active.is_connected():
+                        active.disconnect()
+                    if self.state_writer is not None:
+                        # readers would keep extrapolating the position
+                        with self.metadata_lock:
+                            self.state_writer.stopped()
+
+                if self.disconnected_since is None:
+                    self.disconnected_since = time.monotonic()
+                RECONNECTS.inc()
+
+                delaytime = self.reconnect_delay()
+                self.wakeup.clear()
+                if delaytime:
+                    logging.info("waiting %s seconds before trying to reconnect",
+                                 delaytime)
+                    self.progress(delaytime + LMSWrapper.PROGRESS_TIMEOUT)
+                    self.retry_at = time.monotonic() + delaytime
+                    self.wakeup.wait(delaytime)
+                    self.retry_at = None
+                    self.wakeup.clear()
         except Exception as e:
             logging.error("LMSWrapper thread died: %s", e)
             sys.exit(1)
 
+    def reconnect_delay(self):
+        """
+        Seconds to wait before reconnecting. There is no delay after a
+        network change and only a short one while there is a standby
+        server to switch to. Otherwise the delay doubles with every
+        attempt, starting from 1 second once failover is over.
+        """
+        if self.reconnect_now:
+            self.reconnect_now = False
+            return 0
+        if self.pool.standby is not None and \
+                self.failovers < LMSWrapper.FAILOVER_RETRIES:
+            self.failovers += 1
+            return LMSWrapper.FAILOVER_DELAY if self.failovers > 1 else 0
+        delaytime = min(math.pow(2, self.backoff), LMSWrapper.MAX_DELAY)
+        self.backoff += 1
+        return delaytime
+
+    def progress(self, timeout=PROGRESS_TIMEOUT):
+        """
+        run() is still making progress, it will report again within
+        timeout seconds
+        """
+        self.last_progress = time.monotonic()
+        self.progress_timeout = timeout
+
+    def health(self):
+        """
+        Returns (healthy, description). Not being connected to LMS is
+        not unhealthy as long as the thread keeps trying, a restart
+        wouldn't help with that.
+        """
+        now = time.monotonic()
+        if not self.is_alive():
+            return False, "LMS connector thread died"
+        if now - self.last_progress > self.progress_timeout:
+            return False, "LMS connector stuck for {:.0f}s".format(
+                now - self.last_progress)
+
+        if not self.lms.is_connected():
+            if self.retry_at is not None:
+                return True, "Waiting for LMS, retry in {:.0f}s".format(
+                    max(0, self.retry_at - now))
+            return True, "Connecting to LMS"
+        if self.last_status_time is None:
+            return True, "Connected to {}, waiting for status".format(
+                self.lms.host)
+        return True, "Connected to {}, player {} {}".format(
+            self.lms.host, self.playerid, self.playback_status)
+
+    def subscribe(self):
+        """
+        Subscribe to player status updates, over the CLI or cometd
+        """
+        with self.metadata_lock:
+            # request the track details again from this connection, the
+            # previous one may have died before answering
+            self.track_id = None
+            self.track_info = None
+        if self.config.get("subscription") == "cometd":
+            from cometd import CometdSubscriber
+            subscriber = CometdSubscriber(self.lms.host, self.lms.http_port)
+            # set first, so run() can tell that the subscription failed
+            # and not the CLI connection
+            self.subscriber = subscriber
+            subscriber.add_status_listener(self)
+            subscriber.add_connection_listener(self)
+            subscriber.subscribe(self.playerid, STATUS_TAGS)
+            subscriber.start()
+        else:
+            self.lms.add_status_listener(self)
+            self.lms.send(
+                "{} status - 1 tags:{} subscribe:1".format(
+                    self.playerid, STATUS_TAGS))
+
+    def drop_subscriber(self):
+        subscriber = self.subscriber
+        self.subscriber = None
+        if subscriber is not None:
+            subscriber.remove_status_listener(self)
+            subscriber.remove_connection_listener(self)
+            subscriber.disconnect()
+
+    def selfcheck(self):
+        """
+        Sizes of everything that could grow over time. Counting the
+        objects walks the whole heap, so this is only done on request.
+        """
+        res = {
+            "rss_bytes": metrics.rss_bytes(),
+            "threads": threading.active_count(),
+            "gc_objects": len(gc.get_objects()),
+            "status_listeners": len(self.lms.status_listeners),
+            "line_listeners": len(self.lms.line_listeners),
+            "connection_listeners": len(self.lms.connection_listeners),
+            "network_listeners": len(NETWORKS.listeners),
+            "pending_responses": len(self.lms.pending),
+            "status_slots": len(self.lms.status_queue),
+            "metadata_cache": len(self.enricher.cache),
+            "metadata_queue": self.enricher.requests.qsize(),
+            "known_servers": len(SERVERS.servers),
+            "server_health": len(self.pool.health),
+            "trace_lines": len(tracing.TRACE.lines),
+        }
+        if self.subscriber is not None:
+            res["cometd_status_listeners"] = \
+                len(self.subscriber.status_listeners)
+        return res
+
+    def notify_networks(self, ips):
+        """
+        Our addresses changed (e.g. moving from Wi-Fi to Ethernet), find
+        the server and our player again right away
+        """
+        logging.info("local addresses are now %s, reconnecting", ips)
+        self.reconnect_now = True
+        self.pool.drop_standby()
+        if self.lms.is_connected():
+            self.lms.disconnect()
+        self.wakeup.set()
+
+    def start_discovery(self):
+        if self.pool.discover and self.discovery_listener is None:
+            # keep track of servers in the background, so reconnects
+            # don't have to wait for discovery responses
+            self.discovery_listener = DiscoveryListener()
+            self.discovery_listener.start()
+
+    def notify_config(self, config):
+        """
+        The config file changed. Connect to the new server in the
+        background and switch over once our player has been found there.
+        The D-Bus service and its bus name stay untouched.
+        """
+        with self.migration_lock:
+            self.next_config = config
+            if self.migrator is not None:
+                # the running migrator picks it up when it is done
+                return
+            self.migrator = threading.Thread(target=self.migrate_configs,
+                                             daemon=True)
+            self.migrator.start()
+
+    def migrate_configs(self):
+        # one migration at a time, only the newest config matters
+        while True:
+            with self.migration_lock:
+                config = self.next_config
+                self.next_config = None
+                if config is None:
+                    self.migrator = None
+                    return
+            self.migrate(config)
+
+    def migrate(self, config):
+        """
+        Prepare the switch to a new config. run() applies it, so the pool
+        and config are never replaced while it is using them.
+        """
+        pool = ServerPool(**config)
+        with self.migration_lock:
+            previous = self.migration[1] if self.migration is not None \
+                else self.config
+        resubscribe = config.get("subscription") != \
+            previous.get("subscription")
+        try:
+            lms, me = pool.connect()
+        except Exception as e:
+            logging.warning("can't switch to the new server yet: %s", e)
+            self.set_migration(pool, config)
+            return
+
+        if lms.host == self.lms.host and lms.port == self.lms.port and \
+                self.lms.is_connected() and not resubscribe:
+            # the server didn't change
+            lms.disconnect()
+            self.set_migration(pool, config)
+            return
+
+        logging.info("switching to LMS server at %s", lms.host)
+        self.set_migration(pool, config, lms, me)
+        self.reconnect_now = True
+        self.wakeup.set()
+
+    def set_migration(self, pool, config, lms=None, me=None):
+        with self.migration_lock:
+            replaced = self.migration
+            self.migration = (pool, config, lms, me)
+        if replaced is not None and replaced[2] is not None:
+            # superseded before run() switched to it
+            replaced[2].disconnect()
+
+    def take_migration(self, config_only=False):
+        """
+        Apply a prepared config in the run() thread. Returns the
+        connection and player to switch to, or (None, None) if it should
+        connect through the pool. With config_only, a migration that
+        switches servers is left for the next reconnect.
+        """
+        with self.migration_lock:
+            migration = self.migration
+            if migration is None or \
+                    (config_only and migration[2] is not None):
+                return None, None
+            self.migration = None
+        pool, config, lms, me = migration
+
+        old_pool = self.pool
+        self.config = config
+        self.pool = pool
+        self.start_discovery()
+        old_pool.drop_standby()
+        if lms is not None and lms.is_connected():
+            return lms, me
+        return None, None
+
+    def notify_disconnected(self, lms):
+        if lms is self.lms or lms is self.subscriber:
+            self.wakeup.set()
+
     def send_command(self, cmd):
         """
         send commands like play, pause, ...
@@ -273,38 +447,77 @@ class LMSWrapper(threading.Thread):
 
     def notify_status(self, playerid, lms_meta):
         """
-        Translate metadata returned by MPD to the MPRIS v2 syntax.
-        http://www.freedesktop.org/wiki/Specifications/mpris-spec/metadata
+        Translate the status returned by LMS to the MPRIS v2 syntax.
+        Track details that are not part of the status are added by the
+        metadata enricher.
         """
 
         if playerid == self.playerid:
-            logging.debug("Got status %s", lms_meta)
+            if tracing.DEBUG:
+                logging.debug("Got status %s", lms_meta)
         else:
             # unexpected status update from another player
             return
 
         self.received_data = True
-        self._metadata = {}
-
-        if "artist" in lms_meta:
-            self.metadata["xesam:artist"] = [lms_meta["artist"]]
-
-        if "title" in lms_meta:
-            if "xesam:title" not in self._metadata:
-                self.metadata["xesam:title"] = lms_meta["title"]
-
-        if "album" in lms_meta:
-            if "xesam:album" not in self._metadata:
-                self.metadata["xesam:album"] = lms_meta["album"]
-
-        if "artwork_track_id" in lms_meta:
-            self.metadata["mpris:artUrl"] = self.lms.cover_url(
-                lms_meta["artwork_track_id"])
-
-        if "mode" in lms_meta:
-            self.playback_status = lms_meta["mode"]
+        self.last_status_time = time.monotonic()
+        changed = []
+
+        with self.metadata_lock:
+            if "mode" in lms_meta and \
+                    lms_meta["mode"] != self.playback_status:
+                self.playback_status = lms_meta["mode"]
+                changed.append("PlaybackStatus")
+
+            track_id = lms_meta.get("id")
+            if track_id != self.track_id:
+                self.track_id = track_id
+                self.track_info = None
+                if track_id is not None:
+                    self.track_info = self.enricher.get(self.lms, track_id)
+                    if self.track_info is None:
+                        self.enricher.request(self.lms, track_id)
+
+            self.last_lms_status = lms_meta
+            if self.update_metadata():
+                changed.append("Metadata")
+
+            if self.state_writer is not None:
+                self.state_writer.update(self.playback_status,
+                                         lms_meta.get("time", 0),
+                                         lms_meta.get("duration", 0),
+                                         track_id)
+
+        self.properties_changed(changed)
+
+        # TODO: Implement time tags, repeat and shuffle
+
+    def wants_track_info(self, lms, track_id):
+        return lms is self.lms and track_id == self.track_id
+
+    def notify_track_info(self, lms, track_id, info):
+        with self.metadata_lock:
+            if lms is not self.lms or track_id != self.track_id:
+                return
+            self.track_info = info
+            changed = self.update_metadata()
+        if changed:
+            self.properties_changed(["Metadata"])
+
+    def update_metadata(self):
+        """
+        Rebuild the MPRIS metadata, returns True if it changed
+        """
+        metadata = build_metadata(self.track_id, self.track_info,
+                                  self.last_lms_status, self.lms)
+        if metadata == self.metadata:
+            return False
+        self.metadata = metadata
+        return True
 
-        # TODO: Implement time and duration tags, repeat and shuffle
+    def properties_changed(self, props):
+        if props and self.dbus_service is not None:
+            self.dbus_service.properties_changed(props)
 
     def last_status(self):
         if time.time() - self._time >= 2:
@@ -318,9 +531,11 @@ class LMSWrapper(threading.Thread):
         self._currentsong = self.currentsong()
         self._status = new_status = self.status()
         self._time = new_time = int(time.time())
-        logging.debug("_update_properties: current song = %r" %
-                      self._currentsong)
-        logging.debug("_update_properties: current status = %r" % self._status)
+        if tracing.DEBUG:
+            logging.debug("_update_properties: current song = %r",
+                          self._currentsong)
+            logging.debug("_update_properties: current status = %r",
+                          self._status)
 
         if not new_status:
             return
@@ -351,10 +566,12 @@ class LMSWrapper(threading.Thread):
             else:
                 expected_position = old_position
             if abs(new_position - expected_position) > 0.6:
-                logging.debug("Expected pos %r, actual %r, diff %r" % (
-                    expected_position, new_position, new_position - expected_position))
-                logging.debug("Old position was %r at %r (%r seconds ago)" % (
-                    old_position, old_time, new_time - old_time))
+                if tracing.DEBUG:
+                    logging.debug("Expected pos %r, actual %r, diff %r",
+                                  expected_position, new_position,
+                                  new_position - expected_position)
+                    logging.debug("Old position was %r at %r (%r seconds ago)",
+                                  old_position, old_time, new_time - old_time)
                 self._dbus_service.Seeked(new_position * 1000000)
 
         else:
@@ -388,203 +605,117 @@ class LMSWrapper(threading.Thread):
                                                'CanGoNext')
 
 
-class MPRISInterface(dbus.service.Object):
-    ''' The base object of an MPRIS player '''
-
-    PATH = "/org/mpris/MediaPlayer2"
-    INTROSPECT_INTERFACE = "org.freedesktop.DBus.Introspectable"
-    PROP_INTERFACE = dbus.PROPERTIES_IFACE
-
-    def __init__(self):
-        dbus.service.Object.__init__(self, dbus.SystemBus(),
-                                     MPRISInterface.PATH)
-        self.name = "org.mpris.MediaPlayer2.lms"
-        self.bus = dbus.SystemBus()
-        self.uname = self.bus.get_unique_name()
-        self.dbus_obj = self.bus.get_object("org.freedesktop.DBus",
-                                            "/org/freedesktop/DBus")
-        self.dbus_obj.connect_to_signal("NameOwnerChanged",
-                                        self.name_owner_changed_callback,
-                                        arg0=self.name)
-
-        self.acquire_name()
-        logging.info("name on DBus aqcuired")
-
-    def name_owner_changed_callback(self, name, old_owner, new_owner):
-        if name == self.name and old_owner == self.uname and new_owner != "":
-            try:
-                pid = self._dbus_obj.GetConnectionUnixProcessID(new_owner)
-            except:
-                pid = None
-            logging.info("Replaced by %s (PID %s)" %
-                         (new_owner, pid or "unknown"))
-            loop.quit()
-
-    def acquire_name(self):
-        self.bus_name = dbus.service.BusName(self.name,
-                                             bus=self.bus,
-                                             allow_replacement=True,
-                                             replace_existing=True)
-
-    def release_name(self):
-        if hasattr(self, "_bus_name"):
-            del self.bus_name
-
-    ROOT_INTERFACE = "org.mpris.MediaPlayer2"
-    ROOT_PROPS = {
-        "CanQuit": (False, None),
-        "CanRaise": (False, None),
-        "DesktopEntry": ("lmsmpris", None),
-        "HasTrackList": (False, None),
-        "Identity": (identity, None),
-        "SupportedUriSchemes": (dbus.Array(signature="s"), None),
-        "SupportedMimeTypes": (dbus.Array(signature="s"), None)
-    }
-
-    @dbus.service.method(INTROSPECT_INTERFACE)
-    def Introspect(self):
-        return MPRIS2_INTROSPECTION
-
-    def get_playback_status():
-        status = lms_wrapper.playback_status
-        return {'play': 'Playing',
-                'pause': 'Paused',
-                'stop': 'Stopped',
-                'unknown': 'Unknown'}[status]
-
-    def get_metadata():
-        return dbus.Dictionary(lms_wrapper.metadata, signature='sv')
-
-    PLAYER_INTERFACE = "org.mpris.MediaPlayer2.Player"
-    PLAYER_PROPS = {
-        "PlaybackStatus": (get_playback_status, None),
-        "Rate": (1.0, None),
-        "Metadata": (get_metadata, None),
-        #        "Position": (__get_position, None),
-        "MinimumRate": (1.0, None),
-        "MaximumRate": (1.0, None),
-        "CanGoNext": (True, None),
-        "CanGoPrevious": (True, None),
-        "CanPlay": (True, None),
-        "CanPause": (True, None),
-        "CanSeek": (False, None),
-        "CanControl": (False, None),
-    }
-
-    PROP_MAPPING = {
-        PLAYER_INTERFACE: PLAYER_PROPS,
-        ROOT_INTERFACE: ROOT_PROPS,
-    }
-
-    @dbus.service.signal(PROP_INTERFACE, signature="sa{sv}as")
-    def PropertiesChanged(self, interface, changed_properties,
-                          invalidated_properties):
-        pass
-
-    @dbus.service.method(PROP_INTERFACE,
-                         in_signature="ss", out_signature="v")
-    def Get(self, interface, prop):
-        getter, _setter = self.PROP_MAPPING[interface][prop]
-        if callable(getter):
-            return getter()
-        return getter
-
-    @dbus.service.method(PROP_INTERFACE,
-                         in_signature="ssv", out_signature="")
-    def Set(self, interface, prop, value):
-        _getter, setter = self.PROP_MAPPING[interface][prop]
-        if setter is not None:
-            setter(value)
-
-    @dbus.service.method(PROP_INTERFACE,
-                         in_signature="s", out_signature="a{sv}")
-    def GetAll(self, interface):
-        read_props = {}
-        props = self.PROP_MAPPING[interface]
-        for key, (getter, _setter) in props.items():
-            if callable(getter):
-                getter = getter()
-            read_props[key] = getter
-        return read_props
-
-    def update_property(self, interface, prop):
-        getter, _setter = self.PROP_MAPPING[interface][prop]
-        if callable(getter):
-            value = getter()
-        else:
-            value = getter
-        logging.debug('Updated property: %s = %s' % (prop, value))
-        self.PropertiesChanged(interface, {prop: value}, [])
-        return value
-
-    # Player methods
-    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
-    def Next(self):
-        logging.debug("received DBUS next")
-        lms_wrapper.send_command("next")
-        return
-
-    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
-    def Previous(self):
-        logging.debug("received DBUS previous")
-        lms_wrapper.send_command("previous")
-        return
-
-    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
-    def Pause(self):
-        logging.debug("received DBUS pause")
-        lms_wrapper.send_command("pause")
-        return
-
-    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
-    def PlayPause(self):
-        logging.debug("received DBUS play/pause")
-        status = lms_wrapper.status()
-        if status['state'] == 'play':
-            lms_wrapper.send_command("pause")
-        else:
-            lms_wrapper.send_command("play")
-        return
-
-    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
-    def Stop(self):
-        logging.debug("received DBUS stop")
-        lms_wrapper.send_command("stop")
-        return
+if __name__ == '__main__':
+    tracing.configure(verbose="-v" in sys.argv)
+
+    # --capture=<path> records everything received from LMS for replay.py
+    for arg in sys.argv[1:]:
+        if arg.startswith("--capture="):
+            tracing.start_capture(arg.split("=", 1)[1])
+
+    # Start discovery and the connection to LMS first, it runs in parallel
+    # to the D-Bus setup below
+    lms_wrapper = LMSWrapper()
+    lms_wrapper.start()
+    logging.info("LMS poller thread started")
+
+    import signal
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop
+    try:
+        from gi.repository import GLib
+    except ImportError:
+        import glib as GLib
 
-    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
-    def Play(self):
-        lms_wrapper.send_command("play")
-        return
+    from mprisinterface import MPRISInterface
 
-if __name__ == '__main__':
     DBusGMainLoop(set_as_default=True)
 
-    if len(sys.argv) > 1:
-        if "-v" in sys.argv:
-            logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
-                                level=logging.DEBUG)
-            logging.debug("enabled verbose logging")
-    else:
-        logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
-                            level=logging.INFO)
+    # --metrics-port=<port> serves Prometheus metrics on localhost
+    for arg in sys.argv[1:]:
+        if arg.startswith("--metrics-port="):
+            port = int(arg.split("=", 1)[1])
+            metrics.MetricsServer(port).start()
+            logging.info("serving metrics on port %s", port)
+
+    # --state-file=<path> publishes the playback position for local
+    # readers, an empty path disables it
+    state_file = DEFAULT_STATE_FILE
+    for arg in sys.argv[1:]:
+        if arg.startswith("--state-file="):
+            state_file = arg.split("=", 1)[1]
+    if state_file:
+        try:
+            lms_wrapper.state_writer = PlaybackStateWriter(state_file)
+            logging.info("publishing playback state in %s", state_file)
+        except OSError as e:
+            logging.warning("can't create %s: %s", state_file, e)
 
     # Set up the main loop
     loop = GLib.MainLoop()
 
-    # Create wrapper to handle connection failures with MPD more gracefully
+    # kill -USR1 writes the recent protocol lines to the log
+    def dump_trace(*_args):
+        tracing.TRACE.dump()
+        return True
+
+    # systemd stops the service with SIGTERM, leave the main loop so the
+    # capture and the state file are closed properly
+    def terminate(*_args):
+        logging.info("terminating")
+        loop.quit()
+        return True
+
+    if hasattr(GLib, "unix_signal_add"):
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1,
+                             dump_trace)
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM,
+                             terminate)
+    else:
+        signal.signal(signal.SIGUSR1, dump_trace)
+        signal.signal(signal.SIGTERM, terminate)
+
+    # Acquire the bus name right away, so clients can see us while we
+    # are still connecting to LMS
     try:
-        lms_wrapper = LMSWrapper()
-        lms_wrapper.start()
-        logging.info("LMS poller thread started")
+        lms_wrapper.dbus_service = MPRISInterface(lms_wrapper,
+                                                  on_replaced=loop.quit)
     except dbus.exceptions.DBusException as e:
         logging.error("DBUS error: %s", e)
         sys.exit(1)
 
-    time.sleep(2)
-    if not (lms_wrapper.is_alive()):
-        logging.error("LMS connector thread died, exiting")
-        sys.exit(1)
+    # The service is ready once it owns the bus name. Waiting for LMS
+    # would keep the unit (and units ordered after it) starting for as
+    # long as the server is unreachable, the connection state is
+    # reported in STATUS instead.
+    systemd = SystemdNotifier()
+    systemd.ready(lms_wrapper.health()[1])
+
+    # Health checks run in the main loop, so the systemd watchdog also
+    # notices if the main loop hangs
+    watchdog = watchdog_interval()
+    failed = False
+
+    def check_health():
+        global failed
+        healthy, status = lms_wrapper.health()
+        if not healthy:
+            logging.error("%s, exiting", status)
+            systemd.status(status)
+            failed = True
+            loop.quit()
+            return False
+
+        systemd.status(status)
+        if watchdog:
+            systemd.watchdog()
+        return True
+
+    # twice per watchdog period, at least every 500ms
+    interval = 500
+    if watchdog:
+        interval = min(interval, int(watchdog * 1000 / 2))
+    GLib.timeout_add(interval, check_health)
 
     # Run idle loop
     try:
@@ -592,3 +723,11 @@ if __name__ == '__main__':
         loop.run()
     except KeyboardInterrupt:
         logging.debug('Caught SIGINT, exiting.')
+
+    systemd.stopping()
+    if lms_wrapper.state_writer is not None:
+        lms_wrapper.state_writer.close()
+    tracing.stop_capture()
+
+    if failed or not lms_wrapper.is_alive():
+        sys.exit(1)
@@ -0,0 +1,268 @@
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# Track metadata for MPRIS
+#
+# The status subscription only carries the fields that change while a
+# track is playing. Everything else is requested once per track with
+# songinfo and kept in an LRU cache, so repeated tracks (repeat mode,
+# radio loops) don't need another round trip. Track ids are database ids
+# of a server, so the cache is keyed by server and track id.
+#
+
+import collections
+import logging
+import queue
+import re
+import threading
+
+import metrics
+import tracing
+
+# Requested with every status update: a=artist, d=duration,
+# J=artwork_track_id, K=artwork_url, l=album, N=remote_title, x=remote
+STATUS_TAGS = "adJKlNx"
+
+# Requested once per track: a=artist, A=album artist and other roles,
+# l=album, g=genre, t=tracknum, r=bitrate, u=url
+SONGINFO_TAGS = "aAlgtrudJKNx"
+
+# Fields from the status that override cached ones, e.g. the current
+# title of a radio stream
+LIVE_FIELDS = ("title", "duration", "remote", "remote_title",
+               "artwork_track_id", "artwork_url")
+
+# Change with every song of a radio stream while the track id stays the
+# same, only the status has the current values
+REMOTE_FIELDS = ("artist", "album")
+
+TRACKID_PREFIX = "/org/hifiberry/lms/track/"
+
+CACHE_HITS = metrics.counter("metadata_cache_hits_total",
+                             "Track metadata served from the cache")
+CACHE_MISSES = metrics.counter("metadata_cache_misses_total",
+                               "Track metadata requested from LMS")
+
+
+class LRUCache():
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class MetadataEnricher():
+    """
+    Fetches songinfo for new tracks in a background thread.
+
+    The reader thread must never wait for a command response itself, so
+    requests are queued and the listener is called with
+    notify_track_info(lms, track_id, info) once the data is available.
+    Before a request is sent, listener.wants_track_info(lms, track_id)
+    is asked whether the track is still needed.
+    """
+
+    MAX_BATCH = 20
+    # only the current track matters, the oldest requests are dropped
+    # beyond this
+    MAX_QUEUED = 100
+
+    def __init__(self, listener, cache_size=256):
+        self.listener = listener
+        self.cache = LRUCache(cache_size)
+        self.requests = queue.Queue(MetadataEnricher.MAX_QUEUED)
+        self.pending = set()
+        self.worker = None
+
+    @staticmethod
+    def key(lms, track_id):
+        return ("{}:{}".format(lms.host, lms.port), track_id)
+
+    def get(self, lms, track_id):
+        info = self.cache.get(self.key(lms, track_id))
+        if info is not None:
+            CACHE_HITS.inc()
+        return info
+
+    def request(self, lms, track_id):
+        # per connection, a request queued for a connection that has
+        # been closed doesn't block the same request on a new one
+        if (lms, track_id) in self.pending:
+            return
+        CACHE_MISSES.inc()
+        self.pending.add((lms, track_id))
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+        while True:
+            try:
+                self.requests.put_nowait((lms, track_id))
+                return
+            except queue.Full:
+                pass
+            try:
+                dropped = self.requests.get_nowait()
+            except queue.Empty:
+                continue
+            self.pending.discard(dropped)
+            logging.debug("metadata queue full, dropping track %s",
+                          dropped[1])
+
+    def next_batch(self, carry):
+        """
+        Collect the queued requests for the same server, they are
+        sent together
+        """
+        lms, track_id = carry or self.requests.get()
+        track_ids = [track_id]
+        while len(track_ids) < MetadataEnricher.MAX_BATCH:
+            try:
+                other_lms, track_id = self.requests.get_nowait()
+            except queue.Empty:
+                return lms, track_ids, None
+            if other_lms is not lms:
+                return lms, track_ids, (other_lms, track_id)
+            track_ids.append(track_id)
+        return lms, track_ids, None
+
+    def run(self):
+        carry = None
+        while True:
+            lms, track_ids, carry = self.next_batch(carry)
+            wanted = []
+            try:
+                # skip tracks that aren't current anymore
+                wanted = [track_id for track_id in track_ids
+                          if self.listener.wants_track_info(lms, track_id)]
+                infos = lms.songinfo(wanted, SONGINFO_TAGS) if wanted else []
+                for track_id, info in zip(wanted, infos):
+                    if tracing.DEBUG:
+                        logging.debug("songinfo for %s: %s", track_id, info)
+                    self.cache.put(self.key(lms, track_id), info)
+                    self.listener.notify_track_info(lms, track_id, info)
+            except Exception as e:
+                logging.warning("can't get metadata for tracks %s: %s",
+                                wanted, e)
+            finally:
+                for track_id in track_ids:
+                    self.pending.discard((lms, track_id))
+
+
+def trackid_path(track_id):
+    """
+    D-Bus object path for an LMS track id (remote tracks have negative ids)
+    """
+    return TRACKID_PREFIX + re.sub("[^A-Za-z0-9_]", "_", str(track_id))
+
+
+def to_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def build_metadata(track_id, info, status, lms):
+    """
+    Translate LMS track data to MPRIS v2 metadata
+    http://www.freedesktop.org/wiki/Specifications/mpris-spec/metadata
+    """
+    if track_id is None:
+        return {}
+
+    track = dict(info or {})
+    for field in LIVE_FIELDS:
+        if field in status:
+            track[field] = status[field]
+    if track.get("remote") == "1":
+        for field in REMOTE_FIELDS:
+            if field in status:
+                track[field] = status[field]
+            else:
+                track.pop(field, None)
+
+    metadata = {"mpris:trackid": trackid_path(track_id)}
+
+    if "title" in track:
+        metadata["xesam:title"] = track["title"]
+
+    if "artist" in track:
+        metadata["xesam:artist"] = [track["artist"]]
+
+    if "albumartist" in track:
+        metadata["xesam:albumArtist"] = [track["albumartist"]]
+
+    if "album" in track:
+        metadata["xesam:album"] = track["album"]
+    elif track.get("remote") == "1" and "remote_title" in track:
+        # name of the radio station
+        metadata["xesam:album"] = track["remote_title"]
+
+    if "genre" in track:
+        metadata["xesam:genre"] = [track["genre"]]
+
+    tracknum = to_int(track.get("tracknum"))
+    if tracknum:
+        metadata["xesam:trackNumber"] = tracknum
+
+    duration = track.get("duration")
+    if duration:
+        try:
+            metadata["mpris:length"] = int(float(duration) * 1000000)
+        except ValueError:
+            pass
+
+    if "url" in track:
+        metadata["xesam:url"] = track["url"]
+
+    if "bitrate" in track:
+        metadata["lms:bitrate"] = track["bitrate"]
+
+    if "artwork_track_id" in track:
+        metadata["mpris:artUrl"] = lms.cover_url(track["artwork_track_id"])
+    elif "artwork_url" in track:
+        url = track["artwork_url"]
+        if not url.startswith("http"):
+            url = "http://{}:{}/{}".format(lms.host, lms.http_port,
+                                           url.lstrip("/"))
+        metadata["mpris:artUrl"] = url
+
+    return metadata
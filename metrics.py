@@ -0,0 +1,277 @@
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# Minimal counters, gauges and histograms for the hot paths.
+#
+# Updating a metric is a plain attribute update without locking. Under the
+# GIL an update can get lost if two threads hit the same metric at the same
+# moment, which is acceptable for statistics and keeps the cost per update
+# in the range of a few hundred nanoseconds.
+#
+
+import bisect
+import logging
+import os
+import threading
+import time
+
+# Upper bounds in seconds, suitable for everything from parsing a single
+# line to a discovery run
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+                   0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v)
+                          for k, v in sorted(labels.items())) + "}"
+
+
+class Counter():
+
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name + format_labels(labels), self.value
+
+
+class Gauge():
+
+    kind = "gauge"
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                logging.debug("can't read gauge %s: %s", name, e)
+                return
+        yield name + format_labels(labels), value
+
+
+class Histogram():
+
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return HistogramTimer(self)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in
+        """
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                return float("inf")
+        return float("inf")
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            le = dict(labels or {}, le=repr(bound))
+            yield name + "_bucket" + format_labels(le), cumulative
+        le = dict(labels or {}, le="+Inf")
+        yield name + "_bucket" + format_labels(le), self.count
+        yield name + "_sum" + format_labels(labels), self.sum
+        yield name + "_count" + format_labels(labels), self.count
+
+
+class HistogramTimer():
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+def rss_bytes():
+    """
+    Resident set size of this process
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # peak instead of current usage, in kB on Linux
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Registry():
+
+    def __init__(self, prefix="lmsmpris_"):
+        self.prefix = prefix
+        self.metrics = {}
+        self.help = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def _get(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted((labels or {}).items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = cls(*args)
+                    self.metrics[key] = metric
+                    self.help.setdefault(name, help)
+        return metric
+
+    def counter(self, name, help="", labels=None):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", labels=None, function=None):
+        return self._get(Gauge, name, help, labels, function)
+
+    def histogram(self, name, help="", labels=None, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def collect(self):
+        """
+        Flat name -> value dictionary, histograms are reported as
+        count, sum, p50 and p95
+        """
+        res = {self.prefix + "uptime_seconds": time.time() - self.started}
+        for (name, labels), metric in list(self.metrics.items()):
+            key = self.prefix + name + format_labels(dict(labels))
+            if isinstance(metric, Histogram):
+                res[key + "_count"] = metric.count
+                res[key + "_sum"] = metric.sum
+                res[key + "_p50"] = metric.quantile(0.5)
+                res[key + "_p95"] = metric.quantile(0.95)
+            else:
+                for _sample, value in metric.samples(name, None):
+                    res[key] = value
+        return res
+
+    def prometheus_text(self):
+        lines = []
+        documented = set()
+        for (name, labels), metric in sorted(list(self.metrics.items()),
+                                             key=lambda item: item[0]):
+            fullname = self.prefix + name
+            if name not in documented:
+                documented.add(name)
+                if self.help.get(name):
+                    lines.append("# HELP {} {}".format(fullname,
+                                                       self.help[name]))
+                lines.append("# TYPE {} {}".format(fullname, metric.kind))
+            for sample, value in metric.samples(fullname, dict(labels)):
+                lines.append("{} {}".format(sample, value))
+        lines.append("# TYPE {0}uptime_seconds gauge\n{0}uptime_seconds {1}"
+                     .format(self.prefix, time.time() - self.started))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help="", labels=None):
+    return REGISTRY.counter(name, help, labels)
+
+
+def gauge(name, help="", labels=None, function=None):
+    return REGISTRY.gauge(name, help, labels, function)
+
+
+def histogram(name, help="", labels=None, buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, help, labels, buckets)
+
+
+def prometheus_handler():
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = self.server.registry.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("metrics: " + format, *args)
+
+    return MetricsRequestHandler
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serves the registry in Prometheus text format on a local port
+    """
+
+    def __init__(self, port, host="127.0.0.1", registry=REGISTRY):
+        super().__init__(daemon=True)
+        # only pay for the http.server import if metrics are requested
+        from http.server import HTTPServer
+        self.httpd = HTTPServer((host, port), prometheus_handler())
+        self.httpd.registry = registry
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
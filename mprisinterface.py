@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Modul 9 <info@hifiberry.com>
+# Based on mpDris2 by
+#          Jean-Philippe Braun <eon@patapon.info>,
+#          Mantas Mikulėnas <grawity@gmail.com>
+# Based on mpDris by:
+#          Erik Karlsson <pilo@ayeon.org>
+# Some bits taken from quodlibet mpris plugin by:
+#           <christoph.reiter@gmx.at>
+
+#
+# The MPRIS object exported on the system bus. Kept separate from
+# lmsmpris.py, so dbus is only imported once the service is started.
+#
+
+import logging
+import re
+
+import dbus.service
+
+try:
+    from gi.repository import GLib
+except ImportError:
+    import glib as GLib
+
+import metrics
+import tracing
+
+identity = "LMS client"
+
+SIGNALS = metrics.counter("dbus_signals_total",
+                          "PropertiesChanged signals emitted")
+
+# python dbus bindings don't include annotations and properties
+MPRIS2_INTROSPECTION = """<node name="/org/mpris/MediaPlayer2">
+  <interface name="org.freedesktop.DBus.Introspectable">
+    <method name="Introspect">
+      <arg direction="out" name="xml_data" type="s"/>
+    </method>
+  </interface>
+  <interface name="org.freedesktop.DBus.Properties">
+    <method name="Get">
+      <arg direction="in" name="interface_name" type="s"/>
+      <arg direction="in" name="property_name" type="s"/>
+      <arg direction="out" name="value" type="v"/>
+    </method>
+    <method name="GetAll">
+      <arg direction="in" name="interface_name" type="s"/>
+      <arg direction="out" name="properties" type="a{sv}"/>
+    </method>
+    <method name="Set">
+      <arg direction="in" name="interface_name" type="s"/>
+      <arg direction="in" name="property_name" type="s"/>
+      <arg direction="in" name="value" type="v"/>
+    </method>
+    <signal name="PropertiesChanged">
+      <arg name="interface_name" type="s"/>
+      <arg name="changed_properties" type="a{sv}"/>
+      <arg name="invalidated_properties" type="as"/>
+    </signal>
+  </interface>
+  <interface name="org.mpris.MediaPlayer2">
+    <method name="Raise"/>
+    <method name="Quit"/>
+    <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
+    <property name="CanQuit" type="b" access="read"/>
+    <property name="CanRaise" type="b" access="read"/>
+    <property name="HasTrackList" type="b" access="read"/>
+    <property name="Identity" type="s" access="read"/>
+    <property name="DesktopEntry" type="s" access="read"/>
+    <property name="SupportedUriSchemes" type="as" access="read"/>
+    <property name="SupportedMimeTypes" type="as" access="read"/>
+  </interface>
+  <interface name="org.mpris.MediaPlayer2.Player">
+    <method name="Next"/>
+    <method name="Previous"/>
+    <method name="Pause"/>
+    <method name="PlayPause"/>
+    <method name="Stop"/>
+    <method name="Play"/>
+    <method name="Seek">
+      <arg direction="in" name="Offset" type="x"/>
+    </method>
+    <method name="SetPosition">
+      <arg direction="in" name="TrackId" type="o"/>
+      <arg direction="in" name="Position" type="x"/>
+    </method>
+    <method name="OpenUri">
+      <arg direction="in" name="Uri" type="s"/>
+    </method>
+    <signal name="Seeked">
+      <arg name="Position" type="x"/>
+    </signal>
+    <property name="PlaybackStatus" type="s" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="LoopStatus" type="s" access="readwrite">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="Rate" type="d" access="readwrite">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="Shuffle" type="b" access="readwrite">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="Metadata" type="a{sv}" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="Volume" type="d" access="readwrite">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
+    </property>
+    <property name="Position" type="x" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
+    </property>
+    <property name="MinimumRate" type="d" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="MaximumRate" type="d" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="CanGoNext" type="b" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="CanGoPrevious" type="b" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="CanPlay" type="b" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="CanPause" type="b" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="CanSeek" type="b" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="true"/>
+    </property>
+    <property name="CanControl" type="b" access="read">
+      <annotation name="org.freedesktop.DBus.Property.EmitsChangedSignal" value="false"/>
+    </property>
+  </interface>
+  <interface name="com.hifiberry.lmsmpris.Stats">
+    <method name="GetStats">
+      <arg direction="out" name="stats" type="a{sd}"/>
+    </method>
+  </interface>
+  <interface name="com.hifiberry.lmsmpris.Debug">
+    <method name="DumpTrace">
+      <arg direction="out" name="lines" type="as"/>
+    </method>
+    <method name="SelfCheck">
+      <arg direction="out" name="counts" type="a{sd}"/>
+    </method>
+  </interface>
+</node>"""
+
+# Method calls are timed per method. Names are chosen by the caller, so
+# everything that isn't declared above shares one label.
+DBUS_METHODS = frozenset(re.findall(r'<method name="([^"]+)"',
+                                    MPRIS2_INTROSPECTION))
+
+
+def dbus_metadata(metadata):
+    """
+    Add D-Bus types where the defaults (str, int32) don't match MPRIS
+    """
+    res = dbus.Dictionary({}, signature='sv')
+    for key, value in metadata.items():
+        if key == "mpris:trackid":
+            value = dbus.ObjectPath(value)
+        elif key == "mpris:length":
+            value = dbus.Int64(value)
+        elif isinstance(value, list):
+            value = dbus.Array(value, signature='s')
+        res[key] = value
+    return res
+
+
+class MPRISInterface(dbus.service.Object):
+    ''' The base object of an MPRIS player '''
+
+    PATH = "/org/mpris/MediaPlayer2"
+    INTROSPECT_INTERFACE = "org.freedesktop.DBus.Introspectable"
+    PROP_INTERFACE = dbus.PROPERTIES_IFACE
+    STATS_INTERFACE = "com.hifiberry.lmsmpris.Stats"
+    DEBUG_INTERFACE = "com.hifiberry.lmsmpris.Debug"
+
+    def __init__(self, wrapper, on_replaced=None):
+        dbus.service.Object.__init__(self, dbus.SystemBus(),
+                                     MPRISInterface.PATH)
+        self.wrapper = wrapper
+        self.on_replaced = on_replaced
+        self.name = "org.mpris.MediaPlayer2.lms"
+        self.bus = dbus.SystemBus()
+        self.uname = self.bus.get_unique_name()
+        self.dbus_obj = self.bus.get_object("org.freedesktop.DBus",
+                                            "/org/freedesktop/DBus")
+        self.dbus_obj.connect_to_signal("NameOwnerChanged",
+                                        self.name_owner_changed_callback,
+                                        arg0=self.name)
+
+        self.acquire_name()
+        logging.info("name on DBus aqcuired")
+
+    def name_owner_changed_callback(self, name, old_owner, new_owner):
+        if name == self.name and old_owner == self.uname and new_owner != "":
+            try:
+                pid = self.dbus_obj.GetConnectionUnixProcessID(new_owner)
+            except:
+                pid = None
+            logging.info("Replaced by %s (PID %s)" %
+                         (new_owner, pid or "unknown"))
+            if self.on_replaced is not None:
+                self.on_replaced()
+
+    def _message_cb(self, connection, message):
+        # Single entry point for all incoming method calls, time them here
+        # instead of in every handler
+        member = message.get_member()
+        if member not in DBUS_METHODS:
+            member = "other"
+        with metrics.histogram("dbus_call_seconds",
+                               "Time to handle a D-Bus method call",
+                               labels={"method": member}).time():
+            super()._message_cb(connection, message)
+
+    def acquire_name(self):
+        self.bus_name = dbus.service.BusName(self.name,
+                                             bus=self.bus,
+                                             allow_replacement=True,
+                                             replace_existing=True)
+
+    def release_name(self):
+        if hasattr(self, "_bus_name"):
+            del self.bus_name
+
+    ROOT_INTERFACE = "org.mpris.MediaPlayer2"
+    ROOT_PROPS = {
+        "CanQuit": (False, None),
+        "CanRaise": (False, None),
+        "DesktopEntry": ("lmsmpris", None),
+        "HasTrackList": (False, None),
+        "Identity": (identity, None),
+        "SupportedUriSchemes": (dbus.Array(signature="s"), None),
+        "SupportedMimeTypes": (dbus.Array(signature="s"), None)
+    }
+
+    @dbus.service.method(INTROSPECT_INTERFACE)
+    def Introspect(self):
+        return MPRIS2_INTROSPECTION
+
+    def get_playback_status(self):
+        status = self.wrapper.playback_status
+        return {'play': 'Playing',
+                'pause': 'Paused',
+                'stop': 'Stopped',
+                'unknown': 'Unknown'}[status]
+
+    def get_metadata(self):
+        return dbus_metadata(self.wrapper.metadata)
+
+    PLAYER_INTERFACE = "org.mpris.MediaPlayer2.Player"
+    PLAYER_PROPS = {
+        "PlaybackStatus": (get_playback_status, None),
+        "Rate": (1.0, None),
+        "Metadata": (get_metadata, None),
+        #        "Position": (__get_position, None),
+        "MinimumRate": (1.0, None),
+        "MaximumRate": (1.0, None),
+        "CanGoNext": (True, None),
+        "CanGoPrevious": (True, None),
+        "CanPlay": (True, None),
+        "CanPause": (True, None),
+        "CanSeek": (False, None),
+        "CanControl": (False, None),
+    }
+
+    PROP_MAPPING = {
+        PLAYER_INTERFACE: PLAYER_PROPS,
+        ROOT_INTERFACE: ROOT_PROPS,
+    }
+
+    @dbus.service.signal(PROP_INTERFACE, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed_properties,
+                          invalidated_properties):
+        pass
+
+    @dbus.service.method(PROP_INTERFACE,
+                         in_signature="ss", out_signature="v")
+    def Get(self, interface, prop):
+        getter, _setter = self.PROP_MAPPING[interface][prop]
+        if callable(getter):
+            return getter(self)
+        return getter
+
+    @dbus.service.method(PROP_INTERFACE,
+                         in_signature="ssv", out_signature="")
+    def Set(self, interface, prop, value):
+        _getter, setter = self.PROP_MAPPING[interface][prop]
+        if setter is not None:
+            setter(self, value)
+
+    @dbus.service.method(PROP_INTERFACE,
+                         in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        read_props = {}
+        props = self.PROP_MAPPING[interface]
+        for key, (getter, _setter) in props.items():
+            if callable(getter):
+                getter = getter(self)
+            read_props[key] = getter
+        return read_props
+
+    def update_property(self, interface, prop):
+        getter, _setter = self.PROP_MAPPING[interface][prop]
+        if callable(getter):
+            value = getter(self)
+        else:
+            value = getter
+        if tracing.DEBUG:
+            logging.debug('Updated property: %s = %s', prop, value)
+        self.PropertiesChanged(interface, {prop: value}, [])
+        SIGNALS.inc()
+        return value
+
+    @dbus.service.method(STATS_INTERFACE, in_signature='',
+                         out_signature='a{sd}')
+    def GetStats(self):
+        return {name: float(value)
+                for name, value in metrics.REGISTRY.collect().items()}
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='',
+                         out_signature='as')
+    def DumpTrace(self):
+        return tracing.TRACE.dump()
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='',
+                         out_signature='a{sd}')
+    def SelfCheck(self):
+        return {name: float(value)
+                for name, value in self.wrapper.selfcheck().items()}
+
+    def properties_changed(self, props):
+        """
+        Emit PropertiesChanged for the given player properties. Can be
+        called from any thread, the signal is sent from the main loop.
+        """
+        GLib.idle_add(self._emit_properties_changed, list(props))
+
+    def _emit_properties_changed(self, props):
+        changed = {}
+        for prop in props:
+            getter, _setter = self.PLAYER_PROPS[prop]
+            changed[prop] = getter(self) if callable(getter) else getter
+        self.PropertiesChanged(self.PLAYER_INTERFACE, changed, [])
+        SIGNALS.inc()
+        return False
+
+    # Player methods
+    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
+    def Next(self):
+        logging.debug("received DBUS next")
+        self.wrapper.send_command("next")
+        return
+
+    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
+    def Previous(self):
+        logging.debug("received DBUS previous")
+        self.wrapper.send_command("previous")
+        return
+
+    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
+    def Pause(self):
+        logging.debug("received DBUS pause")
+        self.wrapper.send_command("pause")
+        return
+
+    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
+    def PlayPause(self):
+        logging.debug("received DBUS play/pause")
+        if self.wrapper.playback_status == 'play':
+            self.wrapper.send_command("pause")
+        else:
+            self.wrapper.send_command("play")
+        return
+
+    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
+    def Stop(self):
+        logging.debug("received DBUS stop")
+        self.wrapper.send_command("stop")
+        return
+
+    @dbus.service.method(PLAYER_INTERFACE, in_signature='', out_signature='')
+    def Play(self):
+        self.wrapper.send_command("play")
+        return
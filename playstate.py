@@ -0,0 +1,215 @@
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# Playback state in a memory-mapped file
+#
+# Local consumers (displays, LEDs, web UIs) can read the playback position
+# many times per second without D-Bus calls or requests to LMS. The file
+# has a fixed layout, all values little-endian:
+#
+#   offset  size  field
+#        0     4  magic "LMSP"
+#        4     4  layout version (1)
+#        8     4  sequence number, odd while the writer is updating
+#       12     4  playback status: 0 stopped, 1 paused, 2 playing
+#       16     8  position in microseconds at the reference time
+#       24     8  reference time, CLOCK_MONOTONIC in nanoseconds
+#       32     8  duration in microseconds, 0 if unknown
+#       40     8  playback rate, 1.0 while playing, 0.0 otherwise
+#       48    64  track id, UTF-8, NUL padded
+#
+# The position is not rewritten while playing, readers extrapolate it:
+# position + (now - reference time) * rate.
+#
+# Consistency uses a sequence lock: read the sequence number, retry while
+# it is odd, copy the data, and retry if the sequence number changed in
+# the meantime.
+#
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+DEFAULT_STATE_FILE = "/dev/shm/lmsmpris-playback"
+
+MAGIC = b"LMSP"
+VERSION = 1
+HEADER = struct.Struct("<4sI")
+SEQUENCE = struct.Struct("<I")
+STATE = struct.Struct("<Iqqqd64s")
+HEADER_SIZE = HEADER.size + SEQUENCE.size
+SIZE = HEADER_SIZE + STATE.size
+
+STOPPED = 0
+PAUSED = 1
+PLAYING = 2
+
+LMS_MODES = {"stop": STOPPED, "pause": PAUSED, "play": PLAYING}
+STATUS_NAMES = {STOPPED: "Stopped", PAUSED: "Paused", PLAYING: "Playing"}
+
+
+def to_us(seconds):
+    try:
+        return int(float(seconds) * 1000000)
+    except (TypeError, ValueError):
+        return 0
+
+
+class PlaybackStateWriter():
+    """
+    Publishes the playback state. The file is created under a temporary
+    name and renamed, so readers never see a partial header.
+    """
+
+    # Rewrite the position if it is off by more than this from what
+    # readers extrapolate, in microseconds
+    MAX_DRIFT = 500000
+
+    def __init__(self, path=DEFAULT_STATE_FILE):
+        self.path = path
+        self.sequence = 0
+        self.last = None
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmpname = tempfile.mkstemp(dir=directory, prefix=".lmsmpris")
+        try:
+            os.fchmod(fd, 0o644)
+            os.ftruncate(fd, SIZE)
+            self.map = mmap.mmap(fd, SIZE)
+            HEADER.pack_into(self.map, 0, MAGIC, VERSION)
+            os.replace(tmpname, path)
+        except OSError:
+            os.unlink(tmpname)
+            raise
+        finally:
+            os.close(fd)
+
+    def write(self, status, position, duration, rate, track_id, reference):
+        # odd sequence number: update in progress
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        SEQUENCE.pack_into(self.map, HEADER.size, self.sequence)
+        STATE.pack_into(self.map, HEADER_SIZE, status, position, reference,
+                        duration, rate, track_id.encode()[:64])
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        SEQUENCE.pack_into(self.map, HEADER.size, self.sequence)
+
+    def update(self, mode, position, duration, track_id):
+        """
+        Publish the state from an LMS status: mode is play/pause/stop,
+        position and duration are in seconds. Only writes if something
+        changed or the position drifted from the extrapolated one.
+        """
+        status = LMS_MODES.get(mode, STOPPED)
+        rate = 1.0 if status == PLAYING else 0.0
+        position = to_us(position)
+        duration = to_us(duration)
+        track_id = str(track_id or "")
+        now = time.monotonic_ns()
+
+        last = self.last
+        if last is not None and last[0:4] == (status, duration, rate,
+                                              track_id):
+            expected = last[4] + (now - last[5]) // 1000 * last[2]
+            if abs(expected - position) <= PlaybackStateWriter.MAX_DRIFT:
+                return False
+
+        self.last = (status, duration, rate, track_id, position, now)
+        self.write(status, position, duration, rate, track_id, now)
+        return True
+
+    def stopped(self):
+        """
+        Publish that nothing is playing anymore, e.g. after the connection
+        to LMS was lost. Keeps the track and the position reached.
+        """
+        last = self.last
+        if last is None or last[0] == STOPPED:
+            return False
+        status, duration, rate, track_id, position, reference = last
+        now = time.monotonic_ns()
+        position += int((now - reference) // 1000 * rate)
+        if duration:
+            position = min(position, duration)
+        self.last = (STOPPED, duration, 0.0, track_id, position, now)
+        self.write(STOPPED, position, duration, 0.0, track_id, now)
+        return True
+
+    def close(self, remove=True):
+        self.map.close()
+        if remove:
+            try:
+                os.unlink(self.path)
+            except OSError as e:
+                logging.debug("can't remove %s: %s", self.path, e)
+
+
+class PlaybackStateReader():
+
+    MAX_RETRIES = 1000
+
+    def __init__(self, path=DEFAULT_STATE_FILE):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), SIZE, access=mmap.ACCESS_READ)
+        magic, version = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError("{} is not a playback state file".format(path))
+
+    def read(self):
+        """
+        Consistent copy of the state as a tuple
+        (status, position, reference, duration, rate, track_id)
+        """
+        for _i in range(PlaybackStateReader.MAX_RETRIES):
+            before = SEQUENCE.unpack_from(self.map, HEADER.size)[0]
+            if before & 1:
+                # let the writer finish
+                time.sleep(0)
+                continue
+            state = STATE.unpack_from(self.map, HEADER_SIZE)
+            if SEQUENCE.unpack_from(self.map, HEADER.size)[0] == before:
+                return state
+        raise IOError("playback state is not stable")
+
+    def state(self):
+        status, position, reference, duration, rate, track_id = self.read()
+        if rate:
+            position += int((time.monotonic_ns() - reference) // 1000 * rate)
+        if duration:
+            position = min(position, duration)
+        return {"status": STATUS_NAMES.get(status, "Stopped"),
+                "position": position / 1000000,
+                "duration": duration / 1000000,
+                "track_id": track_id.rstrip(b"\0").decode(errors="replace")}
+
+    def close(self):
+        self.map.close()
+
+
+if __name__ == "__main__":
+    import sys
+    reader = PlaybackStateReader(
+        sys.argv[1] if len(sys.argv) > 1 else DEFAULT_STATE_FILE)
+    print(reader.state())
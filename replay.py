@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# Replay a capture (lmsmpris.py --capture=<path>) through the processing
+# pipeline without a server or D-Bus:
+#
+#   parse    lms.parse_line
+#   status   LMSWrapper.notify_status, including metadata handling
+#   mpris    conversion of changed properties to D-Bus types (only if
+#            dbus-python is installed)
+#
+# songinfo responses in the capture fill the metadata cache, so the
+# metadata path runs as it did when the capture was taken.
+#
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+import tracing
+from benchmark import print_results, summary
+from lms import parse_line, songinfo_to_dict
+from lmsmpris import LMSWrapper
+from metadata import MetadataEnricher
+
+
+class ReplayEnricher(MetadataEnricher):
+    """
+    Track details only come from songinfo responses in the capture
+    """
+
+    def __init__(self, listener):
+        super().__init__(listener)
+        self.misses = 0
+
+    def request(self, lms, track_id):
+        self.misses += 1
+
+    def add(self, track_id, info):
+        lms = self.listener.lms
+        self.cache.put(self.key(lms, track_id), info)
+        self.listener.notify_track_info(lms, track_id, info)
+
+
+class ReplayService():
+    """
+    Stands in for MPRISInterface and times the property conversion
+    """
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.times = []
+        self.signals = 0
+        try:
+            from mprisinterface import dbus_metadata
+            self.dbus_metadata = dbus_metadata
+        except ImportError:
+            self.dbus_metadata = None
+
+    def properties_changed(self, props):
+        start = time.perf_counter()
+        changed = {}
+        for prop in props:
+            if prop == "Metadata":
+                value = self.wrapper.metadata
+                if self.dbus_metadata is not None:
+                    value = self.dbus_metadata(value)
+            else:
+                value = self.wrapper.playback_status
+            changed[prop] = value
+        self.signals += len(changed)
+        self.times.append(time.perf_counter() - start)
+
+
+def first_player(path):
+    for _ts, line in tracing.read_capture(path):
+        parts, status = parse_line(line)
+        if status is not None:
+            return parts[0]
+
+
+def replay(path, playerid=None, speed=None):
+    if playerid is None:
+        playerid = first_player(path)
+
+    wrapper = LMSWrapper(config_file="/nonexistent/squeezelite.json")
+    wrapper.playerid = playerid
+    wrapper.enricher = ReplayEnricher(wrapper)
+    service = ReplayService(wrapper)
+    wrapper.dbus_service = service
+
+    parse_times = []
+    status_times = []
+    lines = 0
+    status_lines = 0
+    last_ts = None
+    start = time.perf_counter()
+    for ts, line in tracing.read_capture(path):
+        if speed and ts is not None and last_ts is not None:
+            time.sleep(max(0, ts - last_ts) / speed)
+        last_ts = ts
+
+        t0 = time.perf_counter()
+        parts, status = parse_line(line)
+        t1 = time.perf_counter()
+        parse_times.append(t1 - t0)
+        lines += 1
+
+        if status is not None:
+            status_lines += 1
+            mpris = len(service.times)
+            wrapper.notify_status(parts[0], status)
+            elapsed = time.perf_counter() - t1
+            # the property conversion is reported separately
+            elapsed -= sum(service.times[mpris:])
+            status_times.append(elapsed)
+        elif parts[0] == "songinfo":
+            for part in parts:
+                if part.startswith("track_id:"):
+                    wrapper.enricher.add(part.split(":", 1)[1],
+                                         songinfo_to_dict(parts))
+    total = time.perf_counter() - start
+
+    return {
+        "replay": {"lines": lines,
+                   "status_lines": status_lines,
+                   "seconds": total,
+                   "lines_per_sec": lines / total if total else 0,
+                   "signals": service.signals,
+                   "metadata_misses": wrapper.enricher.misses},
+        # per line, in microseconds
+        "parse_us": summary(parse_times, 1000000),
+        "status_us": summary(status_times, 1000000),
+        "mpris_us": summary(service.times, 1000000),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a captured LMS session through the "
+                    "parse/status/MPRIS pipeline")
+    parser.add_argument("capture", help="file written by "
+                        "lmsmpris.py --capture=<path>")
+    parser.add_argument("--player", help="player id, default: the first "
+                        "player with a status update in the capture")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="replay at the recorded timing scaled by "
+                        "this factor (default: as fast as possible)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write cProfile statistics to FILE")
+    parser.add_argument("--profile-top", type=int, default=0, metavar="N",
+                        help="print the N most expensive functions")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    parser.add_argument("-v", action="store_true", help="verbose logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(format=tracing.LOG_FORMAT,
+                        level=logging.DEBUG if args.v else logging.WARNING)
+    tracing.refresh()
+
+    profiler = None
+    if args.profile or args.profile_top:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    results = replay(args.capture, args.player, args.speed)
+
+    if profiler is not None:
+        profiler.disable()
+        if args.profile:
+            profiler.dump_stats(args.profile)
+        if args.profile_top:
+            import pstats
+            pstats.Stats(profiler, stream=sys.stderr) \
+                .sort_stats("cumulative").print_stats(args.profile_top)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
@@ -0,0 +1,105 @@
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# systemd service notifications (sd_notify) without libsystemd
+#
+# With a unit like
+#
+#   [Service]
+#   Type=notify
+#   WatchdogSec=10
+#   Restart=on-failure
+#
+# systemd waits for READY=1, shows the STATUS= text in systemctl status
+# and restarts the service if no WATCHDOG=1 arrives within WatchdogSec.
+# Outside of systemd (no NOTIFY_SOCKET), all calls do nothing.
+#
+
+import logging
+import os
+import socket
+
+
+class SystemdNotifier():
+
+    def __init__(self, address=None):
+        if address is None:
+            address = os.environ.get("NOTIFY_SOCKET")
+        self.address = None
+        self.socket = None
+        if address:
+            if address.startswith("@"):
+                # abstract namespace
+                address = "\0" + address[1:]
+            self.address = address
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.last_status = None
+
+    def enabled(self):
+        return self.socket is not None
+
+    def notify(self, *assignments):
+        if self.socket is None:
+            return False
+        try:
+            self.socket.sendto("\n".join(assignments).encode(), self.address)
+            return True
+        except OSError as e:
+            logging.debug("sd_notify failed: %s", e)
+            return False
+
+    def ready(self, status=None):
+        if status is not None:
+            self.last_status = status
+            return self.notify("READY=1", "STATUS=" + status)
+        return self.notify("READY=1")
+
+    def status(self, status):
+        # systemd only needs to hear about changes
+        if status == self.last_status:
+            return True
+        self.last_status = status
+        return self.notify("STATUS=" + status)
+
+    def watchdog(self):
+        return self.notify("WATCHDOG=1")
+
+    def stopping(self):
+        return self.notify("STOPPING=1")
+
+
+def watchdog_interval():
+    """
+    Watchdog timeout in seconds if the watchdog is enabled for this
+    process, otherwise None
+    """
+    usec = os.environ.get("WATCHDOG_USEC")
+    pid = os.environ.get("WATCHDOG_PID")
+    if not usec:
+        return None
+    if pid and pid != str(os.getpid()):
+        return None
+    try:
+        return int(usec) / 1000000
+    except ValueError:
+        return None
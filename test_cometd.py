@@ -0,0 +1,62 @@
+import http.client
+import json
+
+from cometd import CometdSubscriber
+
+
+class Pool():
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.closed = False
+
+    def post(self, path, body):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return json.dumps(response).encode()
+
+    def close(self):
+        self.closed = True
+
+
+class Listener():
+
+    def __init__(self):
+        self.status = []
+        self.disconnected = []
+
+    def notify_status(self, playerid, status):
+        self.status.append((playerid, status))
+
+    def notify_disconnected(self, subscriber):
+        self.disconnected.append(subscriber)
+
+
+def subscriber(responses):
+    sub = CometdSubscriber("127.0.0.1")
+    sub.client_id = "abc"
+    sub.pool = Pool(responses)
+    sub.running = True
+    listener = Listener()
+    sub.add_connection_listener(listener)
+    return sub, listener
+
+
+def test_http_exception_notifies():
+    sub, listener = subscriber([http.client.IncompleteRead(b"")])
+    sub.run()
+    assert not sub.is_connected()
+    assert sub.pool.closed
+    assert listener.disconnected == [sub]
+
+
+def test_unexpected_messages():
+    connect = {"channel": "/meta/connect", "successful": True}
+    channel = "/abc/slim/playerstatus/00:01"
+    sub, listener = subscriber([
+        [connect, "junk", {"channel": channel, "data": "junk"}],
+        {"error": "not a list"},
+    ])
+    sub.run()
+    assert listener.disconnected == [sub]
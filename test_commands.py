@@ -0,0 +1,129 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from lms import CommandTimeout, LMS, PendingResponse
+
+
+def connected():
+    """
+    LMS connected to one end of a socket pair, the test plays the server
+    on the other end
+    """
+    client, server = socket.socketpair()
+    lms = LMS("127.0.0.1")
+    lms.socket = client
+    threading.Thread(target=lms.listen, daemon=True).start()
+    return lms, server, server.makefile("rw", newline="\n")
+
+
+def test_pending_response():
+    pending = PendingResponse("00:01 mode ?")
+    assert not pending.matches(["00:01", "mode"])
+    assert not pending.matches(["00:02", "mode", "play"])
+    assert pending.matches(["00:01", "mode", "?", "play"])
+    threading.Timer(0.05, pending.notify_line,
+                    [["00:01", "mode", "play"]]).start()
+    assert pending.result(5) == ["00:01", "mode", "play"]
+
+
+def test_pending_response_timeout():
+    pending = PendingResponse("00:01 mode ?")
+    start = time.monotonic()
+    with pytest.raises(CommandTimeout):
+        pending.result(0.05)
+    assert time.monotonic() - start < 1
+    assert not pending.done()
+
+
+def test_pending_response_cancel():
+    pending = PendingResponse("00:01 mode ?")
+    threading.Timer(0.05, pending.cancel,
+                    [IOError("connection lost")]).start()
+    with pytest.raises(IOError, match="connection lost"):
+        pending.result(5)
+    assert pending.done()
+
+
+def test_cancel_pending():
+    lms = LMS("127.0.0.1")
+    first = PendingResponse("players 0 10")
+    second = PendingResponse("00:01 mode ?")
+    lms.pending = [first, second]
+
+    lms.dispatch_response(["00:01", "mode", "?", "pause"])
+    assert second.result(0) == ["00:01", "mode", "?", "pause"]
+    assert lms.pending == [first]
+
+    lms.cancel_pending(IOError("connection lost"))
+    assert lms.pending == []
+    with pytest.raises(IOError, match="connection lost"):
+        first.result(0)
+
+
+def test_request_not_connected():
+    lms = LMS("127.0.0.1")
+    with pytest.raises(IOError):
+        lms.request("players 0 10")
+    assert lms.pending == []
+
+
+def test_cmd_responses_pipelined():
+    lms, _sock, server = connected()
+    result = []
+    worker = threading.Thread(target=lambda: result.append(
+        lms.cmd_responses(["00:01 mode ?", "00:01 time ?"], timeout=5)))
+    worker.start()
+    # both commands are sent before the first response arrives
+    assert server.readline() == "00:01 mode ?\n"
+    assert server.readline() == "00:01 time ?\n"
+    server.write("00:01 time ? 12.5\n00:01 mode ? play\n")
+    server.flush()
+    worker.join(5)
+    assert result == [[["00:01", "mode", "?", "play"],
+                       ["00:01", "time", "?", "12.5"]]]
+    assert lms.pending == []
+    lms.disconnect()
+
+
+def test_cmd_response_connection_lost():
+    lms, sock, server = connected()
+    errors = []
+
+    def request():
+        try:
+            lms.cmd_response("00:01 mode ?", timeout=5)
+        except IOError as e:
+            errors.append(e)
+
+    worker = threading.Thread(target=request)
+    worker.start()
+    assert server.readline() == "00:01 mode ?\n"
+    start = time.monotonic()
+    server.close()
+    sock.close()
+    worker.join(5)
+    assert len(errors) == 1 and not isinstance(errors[0], CommandTimeout)
+    assert time.monotonic() - start < 1
+    assert lms.pending == []
+
+
+def test_disconnect_after_connection_lost():
+    lms, sock, server = connected()
+    lost = threading.Event()
+
+    class Listener():
+        def notify_disconnected(self, _lms):
+            lost.set()
+
+    listener = Listener()
+    lms.add_connection_listener(listener)
+    server.close()
+    sock.close()
+    assert lost.wait(5)
+    assert not lms.is_connected()
+    # the reader thread closed the connection already
+    lms.disconnect()
+    lms.disconnect()
@@ -0,0 +1,205 @@
+import socket
+import threading
+import time
+
+from lms import LMS, STATUS_COLLAPSED, Listeners, NetworkMonitor, \
+    ServerPool, StatusQueue, parse_discovery_response
+
+
+class NetworkListener():
+
+    def __init__(self):
+        self.changes = []
+
+    def notify_networks(self, ips):
+        self.changes.append(ips)
+
+
+def net(*addrs):
+    return [{"addr": addr, "netmask": "255.255.255.0"} for addr in addrs]
+
+
+def test_network_changes():
+    monitor = NetworkMonitor()
+    listener = NetworkListener()
+    monitor.add_listener(listener)
+
+    # the first list is the baseline
+    monitor.set_networks(net("127.0.0.1", "192.168.1.10"))
+    assert listener.changes == []
+    assert monitor.networks() == net("127.0.0.1", "192.168.1.10")
+
+    # same addresses, different order or loopback only changes
+    monitor.set_networks(net("192.168.1.10", "127.0.0.1"))
+    monitor.set_networks(net("192.168.1.10", "127.0.1.1"))
+    assert listener.changes == []
+
+    # Wi-Fi to Ethernet
+    monitor.set_networks(net("127.0.0.1", "10.0.0.5"))
+    assert listener.changes == [["10.0.0.5"]]
+    monitor.set_networks(net("127.0.0.1", "10.0.0.5", "192.168.1.10"))
+    assert listener.changes == [["10.0.0.5"], ["10.0.0.5", "192.168.1.10"]]
+
+
+def tlv(tag, value):
+    return tag + bytes([len(value)]) + value
+
+
+def test_discovery_response():
+    data = b"E" + tlv(b"NAME", b"lms") + tlv(b"IPAD", b"192.168.1.2") + \
+        tlv(b"JSON", b"9000") + tlv(b"UUID", b"abc")
+    assert parse_discovery_response(data) == {
+        "name": "lms", "host": "192.168.1.2", "http_port": "9000",
+        "uuid": "abc"}
+
+
+def test_discovery_unknown_tag():
+    data = b"E" + tlv(b"XTRA", b"1") + tlv(b"NAME", b"lms")
+    assert parse_discovery_response(data) == {"xtra": "1", "name": "lms"}
+
+
+def test_discovery_utf8_name():
+    name = "Küche ♫".encode()
+    data = b"E" + tlv(b"NAME", name) + tlv(b"JSON", b"9000")
+    assert parse_discovery_response(data) == {"name": "Küche ♫",
+                                              "http_port": "9000"}
+
+
+def test_discovery_truncated():
+    data = b"E" + tlv(b"NAME", b"lms") + tlv(b"JSON", b"9000")[:-2]
+    assert parse_discovery_response(data) == {"name": "lms"}
+    # tag without its length byte
+    assert parse_discovery_response(b"E" + tlv(b"NAME", b"lms") + b"JSO") \
+        == {"name": "lms"}
+
+
+def test_discovery_not_a_response():
+    assert parse_discovery_response(b"") is None
+    assert parse_discovery_response(b"eNAME\0") is None
+    assert parse_discovery_response(b"d" + tlv(b"NAME", b"lms")) is None
+
+
+class FakeServer():
+
+    def __init__(self, host, players=None, error=None):
+        self.host = host
+        self.players = players or []
+        self.error = error
+        self.connected = True
+
+    def server_info(self):
+        return {"host": self.host, "port": 9090, "http_port": 9000}
+
+    def client(self, iplist):
+        if self.error is not None:
+            raise self.error
+        for player in self.players:
+            if player["ip"].split(":")[0] in iplist:
+                return player
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+
+class FakePool(ServerPool):
+
+    def __init__(self, servers):
+        super().__init__([server.server_info() for server in servers],
+                         discover=False)
+        self.fakes = {server.host: server for server in servers}
+        self.opened = []
+
+    def open(self, server):
+        lms = self.fakes[server["host"]]
+        lms.connected = True
+        self.opened.append(lms)
+        return lms
+
+
+def test_connect_skips_failing_server():
+    me = {"playerid": "00:01", "ip": "10.0.0.5:3483"}
+    bad = FakeServer("a", error=IOError("bad players reply"))
+    good = FakeServer("b", players=[me])
+    pool = FakePool([bad, good])
+
+    assert pool.connect(["10.0.0.5"]) == (good, me)
+    assert not bad.connected
+    assert "failed" in pool.health[pool.key(bad.server_info())]
+
+    # the failed server is tried last now
+    pool.opened = []
+    pool.connect(["10.0.0.5"])
+    assert pool.opened == [good]
+
+
+def test_connect_failing_standby():
+    me = {"playerid": "00:01", "ip": "10.0.0.5:3483"}
+    standby = FakeServer("a", error=IOError("timeout"))
+    good = FakeServer("b", players=[me])
+    pool = FakePool([standby, good])
+    pool.standby = standby
+
+    assert pool.connect(["10.0.0.5"]) == (good, me)
+    assert not standby.connected
+    assert pool.standby is None
+    assert pool.opened == [good]
+
+
+class BlockingListener():
+
+    def __init__(self):
+        self.received = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def notify_status(self, playerid, status):
+        self.entered.set()
+        self.release.wait(5)
+        self.received.append((playerid, status["seq"]))
+
+
+def test_status_queue_keeps_latest():
+    listeners = Listeners()
+    listener = BlockingListener()
+    listeners.add(listener)
+    queue = StatusQueue(listeners)
+    collapsed = STATUS_COLLAPSED.value
+
+    queue.put("00:01", {"seq": 0})
+    assert listener.entered.wait(5)
+    # the listener is busy, later updates replace each other
+    for seq in range(1, 6):
+        queue.put("00:01", {"seq": seq})
+    queue.put("00:02", {"seq": 1})
+    assert len(queue) == 2
+    assert STATUS_COLLAPSED.value - collapsed == 4
+
+    listener.release.set()
+    queue.close()
+    deadline = time.monotonic() + 5
+    while queue.worker is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert listener.received == [("00:01", 0), ("00:01", 5), ("00:02", 1)]
+
+
+def test_response_while_listener_blocked():
+    client, server = socket.socketpair()
+    lms = LMS("127.0.0.1")
+    lms.socket = client
+    threading.Thread(target=lms.listen, daemon=True).start()
+    listener = BlockingListener()
+    lms.add_status_listener(listener)
+
+    server.sendall(b"00%3A01 status - 1 seq%3A1\n")
+    assert listener.entered.wait(5)
+    pending = lms.request("00:01 mode ?")
+    server.sendall(b"00%3A01 mode ? play\n")
+    try:
+        assert pending.result(1) == ["00:01", "mode", "?", "play"]
+    finally:
+        listener.release.set()
+        lms.disconnect()
+        server.close()
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from lmsconfig import parse_config, read_config
+
+
+def test_defaults():
+    assert parse_config({}) == {
+        "servers": [],
+        "discover": True,
+        "warm_standby": False,
+        "http_calls": [],
+        "subscription": "cli",
+    }
+
+
+def test_servers():
+    config = parse_config({
+        "server": {"value": " lms.local ", "port": "9091"},
+        "fallback_servers": [{"value": "lms2.local", "http_port": 9001},
+                             {"value": ""}],
+    })
+    assert config["servers"] == [
+        {"host": "lms.local", "port": 9091, "http_port": 9000},
+        {"host": "lms2.local", "port": 9090, "http_port": 9001},
+    ]
+    # discovery is off by default once a server is configured
+    assert config["discover"] is False
+
+
+@pytest.mark.parametrize("data", [
+    {"server": {"value": "lms.local", "port": 0}},
+    {"server": {"value": "lms.local", "port": 65536}},
+    {"server": {"value": "lms.local", "http_port": "http"}},
+    {"server": {"value": 42}},
+    {"server": "lms.local"},
+    {"subscription": "websocket"},
+    {"http_calls": "players"},
+    {"http_calls": ["status"]},
+])
+def test_invalid(data):
+    with pytest.raises(ValueError):
+        parse_config(data)
+
+
+def test_read_config(tmp_path):
+    path = tmp_path / "squeezelite.json"
+    path.write_text(json.dumps({"server": {"value": "lms.local"},
+                                "http_calls": ["songinfo", "players",
+                                               "songinfo"],
+                                "subscription": "cometd"}))
+    config = read_config(str(path))
+    assert config["http_calls"] == ["players", "songinfo"]
+    assert config["subscription"] == "cometd"
+
+    path.write_text("[]")
+    with pytest.raises(ValueError):
+        read_config(str(path))
+    path.write_text("{")
+    with pytest.raises(ValueError):
+        read_config(str(path))
@@ -0,0 +1,99 @@
+import threading
+
+from lms import ServerPool
+from lmsmpris import LMSWrapper
+
+
+def wrapper():
+    return LMSWrapper(config_file="/nonexistent/squeezelite.json")
+
+
+def test_reconnect_delay_backoff():
+    lms_wrapper = wrapper()
+    delays = [lms_wrapper.reconnect_delay() for _i in range(12)]
+    assert delays == [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 600, 600]
+
+
+def test_reconnect_delay_failover():
+    lms_wrapper = wrapper()
+    lms_wrapper.pool.standby = object()
+    delays = [lms_wrapper.reconnect_delay() for _i in range(15)]
+    # the back-off starts from 1s once the standby didn't help
+    assert delays == [0] + [LMSWrapper.FAILOVER_DELAY] * 9 + [1, 2, 4, 8, 16]
+
+
+def test_reconnect_delay_network_change():
+    lms_wrapper = wrapper()
+    lms_wrapper.backoff = 5
+    lms_wrapper.reconnect_now = True
+    assert lms_wrapper.reconnect_delay() == 0
+    assert not lms_wrapper.reconnect_now
+    assert lms_wrapper.reconnect_delay() == 32
+
+
+class Connection():
+
+    def __init__(self):
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+
+def test_replaced_migration_is_disconnected():
+    lms_wrapper = wrapper()
+    first = Connection()
+    lms_wrapper.set_migration(None, {"servers": []}, first, {})
+    second = Connection()
+    lms_wrapper.set_migration(None, {"servers": []}, second, {})
+    assert not first.connected
+    assert second.connected
+
+
+def test_take_migration():
+    lms_wrapper = wrapper()
+    old_pool = lms_wrapper.pool
+    new_pool = ServerPool(discover=False)
+    lms = Connection()
+    config = dict(lms_wrapper.config, discover=False)
+    lms_wrapper.set_migration(new_pool, config, lms, {"playerid": "00:01"})
+
+    # switching servers waits for a reconnect
+    assert lms_wrapper.take_migration(config_only=True) == (None, None)
+    assert lms_wrapper.pool is old_pool
+
+    assert lms_wrapper.take_migration() == (lms, {"playerid": "00:01"})
+    assert lms_wrapper.pool is new_pool
+    assert lms_wrapper.config is config
+    assert lms_wrapper.migration is None
+
+
+def test_one_migration_at_a_time():
+    lms_wrapper = wrapper()
+    running = []
+    migrated = []
+    first_started = threading.Event()
+    release = threading.Event()
+
+    def migrate(config):
+        running.append(config)
+        assert len(running) == 1
+        first_started.set()
+        release.wait(5)
+        migrated.append(config["name"])
+        running.remove(config)
+
+    lms_wrapper.migrate = migrate
+    lms_wrapper.notify_config({"name": "first"})
+    assert first_started.wait(5)
+    lms_wrapper.notify_config({"name": "second"})
+    lms_wrapper.notify_config({"name": "third"})
+    migrator = lms_wrapper.migrator
+    release.set()
+    migrator.join(5)
+    # only the newest config is applied after the running migration
+    assert migrated == ["first", "third"]
+    assert lms_wrapper.migrator is None
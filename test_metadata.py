@@ -0,0 +1,97 @@
+import threading
+
+from lms import LMS
+from metadata import MetadataEnricher, build_metadata
+
+
+class Listener():
+
+    def __init__(self, current=None):
+        self.infos = []
+        self.current = current
+        self.got_info = threading.Event()
+
+    def wants_track_info(self, lms, track_id):
+        return self.current is None or track_id == self.current
+
+    def notify_track_info(self, lms, track_id, info):
+        self.infos.append((lms, track_id, info))
+        self.got_info.set()
+
+
+class SongInfoServer():
+
+    host = "192.168.1.2"
+    port = 9090
+
+    def __init__(self):
+        self.requested = []
+
+    def songinfo(self, track_ids, tags):
+        self.requested.append(list(track_ids))
+        return [{"title": "Track " + track_id} for track_id in track_ids]
+
+
+def test_full_queue_drops_oldest():
+    enricher = MetadataEnricher(Listener())
+    # no worker, requests stay queued
+    enricher.worker = threading.current_thread()
+    lms = SongInfoServer()
+    for track_id in range(MetadataEnricher.MAX_QUEUED + 10):
+        enricher.request(lms, str(track_id))
+    queued = [enricher.requests.get_nowait()[1]
+              for _i in range(enricher.requests.qsize())]
+    assert len(queued) == MetadataEnricher.MAX_QUEUED
+    assert queued[0] == "10"
+    assert queued[-1] == str(MetadataEnricher.MAX_QUEUED + 9)
+    assert (lms, "0") not in enricher.pending
+
+
+def test_only_current_track_requested():
+    listener = Listener(current="3")
+    enricher = MetadataEnricher(listener)
+    enricher.worker = threading.current_thread()
+    lms = SongInfoServer()
+    for track_id in ("1", "2", "3"):
+        enricher.request(lms, track_id)
+    threading.Thread(target=enricher.run, daemon=True).start()
+    assert listener.got_info.wait(5)
+    assert lms.requested == [["3"]]
+    assert listener.infos == [(lms, "3", {"title": "Track 3"})]
+    assert enricher.get(lms, "3") == {"title": "Track 3"}
+
+
+def test_cache_per_server():
+    enricher = MetadataEnricher(Listener())
+    lms1 = LMS("192.168.1.2")
+    lms2 = LMS("192.168.1.3")
+    enricher.cache.put(enricher.key(lms1, "12"), {"artist": "A"})
+    assert enricher.get(lms1, "12") == {"artist": "A"}
+    assert enricher.get(LMS("192.168.1.2"), "12") == {"artist": "A"}
+    assert enricher.get(lms2, "12") is None
+
+
+def test_remote_artist_from_status():
+    lms = LMS("192.168.1.2")
+    cached = {"artist": "First", "album": "First album", "genre": "Jazz"}
+    status = {"remote": "1", "title": "Second song", "artist": "Second",
+              "album": "Second album", "remote_title": "Radio"}
+    metadata = build_metadata("-1", cached, status, lms)
+    assert metadata["xesam:artist"] == ["Second"]
+    assert metadata["xesam:album"] == "Second album"
+    assert metadata["xesam:genre"] == ["Jazz"]
+
+    # no artist in the stream: don't show the cached one
+    status = {"remote": "1", "title": "Jingle", "remote_title": "Radio"}
+    metadata = build_metadata("-1", cached, status, lms)
+    assert "xesam:artist" not in metadata
+    assert metadata["xesam:album"] == "Radio"
+
+
+def test_local_track_uses_cache():
+    lms = LMS("192.168.1.2")
+    cached = {"artist": "Artist", "albumartist": "Various", "album": "Album"}
+    metadata = build_metadata("12", cached, {"title": "Song"}, lms)
+    assert metadata["xesam:artist"] == ["Artist"]
+    assert metadata["xesam:albumArtist"] == ["Various"]
+    assert metadata["xesam:album"] == "Album"
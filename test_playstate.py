@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from playstate import PlaybackStateReader, PlaybackStateWriter
+
+
+@pytest.fixture
+def state_file(tmp_path):
+    path = str(tmp_path / "playback")
+    writer = PlaybackStateWriter(path)
+    reader = PlaybackStateReader(path)
+    yield writer, reader
+    reader.close()
+    writer.close()
+
+
+def test_round_trip(state_file):
+    writer, reader = state_file
+    assert writer.update("pause", "12.5", "300", "-42")
+    state = reader.state()
+    assert state == {"status": "Paused", "position": 12.5,
+                     "duration": 300.0, "track_id": "-42"}
+
+    # nothing changed, nothing written
+    assert not writer.update("pause", "12.5", "300", "-42")
+
+
+def test_extrapolated_position(state_file):
+    writer, reader = state_file
+    writer.update("play", 10, 300, "12")
+    time.sleep(0.1)
+    position = reader.state()["position"]
+    assert 10.05 < position < 11
+    # within the drift limit, readers extrapolate
+    assert not writer.update("play", position, 300, "12")
+    # a seek is written
+    assert writer.update("play", 100, 300, "12")
+    assert 100 <= reader.state()["position"] < 101
+
+
+def test_stopped(state_file):
+    writer, reader = state_file
+    assert not writer.stopped()
+    writer.update("play", 10, 300, "12")
+    assert writer.stopped()
+    state = reader.state()
+    time.sleep(0.05)
+    assert state["status"] == "Stopped"
+    assert state["track_id"] == "12"
+    assert reader.state()["position"] == state["position"]
+    assert not writer.stopped()
+
+
+def test_consistent_reads(state_file):
+    writer, reader = state_file
+    done = threading.Event()
+
+    def write():
+        i = 0
+        while not done.is_set():
+            i += 1
+            # position, duration and track id always match
+            writer.write(2, i, i, 1.0, str(i), i)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        for _i in range(20000):
+            status, position, reference, duration, rate, track_id = \
+                reader.read()
+            assert position == duration == reference
+            if position:
+                assert track_id.rstrip(b"\0") == str(position).encode()
+    finally:
+        done.set()
+        thread.join()
+
+
+def test_not_a_state_file(tmp_path):
+    path = tmp_path / "other"
+    path.write_bytes(b"\0" * 200)
+    with pytest.raises(ValueError):
+        PlaybackStateReader(str(path))
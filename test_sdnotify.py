@@ -0,0 +1,71 @@
+import os
+import socket
+
+import pytest
+
+from sdnotify import SystemdNotifier, watchdog_interval
+
+
+@pytest.fixture
+def notify_socket(tmp_path):
+    path = str(tmp_path / "notify")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(1)
+    yield path, sock
+    sock.close()
+
+
+def received(sock):
+    return sock.recv(4096).decode().split("\n")
+
+
+def test_notifications(notify_socket):
+    path, sock = notify_socket
+    systemd = SystemdNotifier(path)
+    assert systemd.enabled()
+
+    assert systemd.ready("Connecting to LMS")
+    assert received(sock) == ["READY=1", "STATUS=Connecting to LMS"]
+
+    # unchanged status isn't sent again
+    assert systemd.status("Connecting to LMS")
+    assert systemd.status("Connected to lms.local")
+    assert received(sock) == ["STATUS=Connected to lms.local"]
+
+    assert systemd.watchdog()
+    assert received(sock) == ["WATCHDOG=1"]
+    assert systemd.stopping()
+    assert received(sock) == ["STOPPING=1"]
+
+
+def test_abstract_address():
+    name = "lmsmpris-test-{}".format(os.getpid())
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind("\0" + name)
+    sock.settimeout(1)
+    try:
+        systemd = SystemdNotifier("@" + name)
+        assert systemd.watchdog()
+        assert received(sock) == ["WATCHDOG=1"]
+    finally:
+        sock.close()
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.delenv("NOTIFY_SOCKET", raising=False)
+    systemd = SystemdNotifier()
+    assert not systemd.enabled()
+    assert not systemd.ready()
+    assert not systemd.watchdog()
+
+
+def test_watchdog_interval(monkeypatch):
+    monkeypatch.delenv("WATCHDOG_USEC", raising=False)
+    assert watchdog_interval() is None
+    monkeypatch.setenv("WATCHDOG_USEC", "10000000")
+    monkeypatch.setenv("WATCHDOG_PID", str(os.getpid()))
+    assert watchdog_interval() == 10
+    # meant for another process
+    monkeypatch.setenv("WATCHDOG_PID", str(os.getpid() + 1))
+    assert watchdog_interval() is None
@@ -0,0 +1,37 @@
+import gzip
+
+import pytest
+
+import tracing
+
+
+@pytest.mark.parametrize("name", ["capture.txt", "capture.txt.gz"])
+def test_capture_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    capture = tracing.ProtocolCapture(path)
+    capture.write("00%3A01 status - 1 mode%3Aplay")
+    capture.write("players 0 1 count%3A1")
+    capture.close()
+    lines = list(tracing.read_capture(path))
+    assert [line for _ts, line in lines] == [
+        "00%3A01 status - 1 mode%3Aplay", "players 0 1 count%3A1"]
+    assert all(ts is not None for ts, _line in lines)
+
+
+def test_truncated_gzip_capture(tmp_path):
+    path = str(tmp_path / "capture.txt.gz")
+    data = gzip.compress("".join("{}\tline {}\n".format(i, i)
+                                 for i in range(1000)).encode())
+    # no trailer, as if the process was killed
+    with open(path, "wb") as f:
+        f.write(data[:-8])
+    lines = [line for _ts, line in tracing.read_capture(path)]
+    assert lines[0] == "line 0"
+    assert len(lines) <= 1000
+
+
+def test_truncated_line(tmp_path):
+    path = tmp_path / "capture.txt"
+    path.write_text("# capture\n0.1\tline 1\nline 2\n0.3\tli")
+    assert list(tracing.read_capture(str(path))) == [(0.1, "line 1"),
+                                                     (None, "line 2")]
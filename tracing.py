@@ -0,0 +1,179 @@
+'''
+Copyright (c) 2018 Modul 9/HiFiBerry
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+#
+# Logging setup and protocol tracing
+#
+# Hot paths check the module level DEBUG flag before calling logging.debug,
+# so nothing is formatted or even passed to the logging module when debug
+# logging is off. The flag is computed once by configure()/refresh().
+#
+# Independent of the log level, the last protocol lines are kept in a ring
+# buffer. Recording a line stores a reference to the string, formatting
+# only happens when the buffer is dumped.
+#
+# For offline analysis, all received lines can also be captured to a file,
+# one line per protocol line: seconds since the start of the capture, a
+# tab and the raw (still percent-encoded) line. Files ending in .gz are
+# compressed. replay.py and fakelms.py read this format.
+#
+
+import collections
+import gzip
+import logging
+import threading
+import time
+
+LOG_FORMAT = '%(levelname)s: %(name)s - %(message)s'
+
+DEBUG = False
+
+TRACE_SIZE = 1000
+
+
+def refresh():
+    """
+    Re-read the log level after it has been changed at runtime
+    """
+    global DEBUG
+    DEBUG = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+def configure(verbose=False):
+    logging.basicConfig(format=LOG_FORMAT,
+                        level=logging.DEBUG if verbose else logging.INFO)
+    refresh()
+    if verbose:
+        logging.debug("enabled verbose logging")
+
+
+class ProtocolTrace():
+    """
+    Bounded buffer of the most recent protocol lines
+    """
+
+    SENT = ">"
+    RECEIVED = "<"
+
+    def __init__(self, size=TRACE_SIZE):
+        self.lines = collections.deque(maxlen=size)
+
+    def record(self, direction, line):
+        self.lines.append((time.monotonic(), direction, line))
+
+    def format(self):
+        now = time.monotonic()
+        return ["{:9.3f} {} {}".format(ts - now, direction, line)
+                for ts, direction, line in list(self.lines)]
+
+    def dump(self):
+        """
+        Write the buffer to the log, independent of the log level
+        """
+        lines = self.format()
+        logger = logging.getLogger()
+        for line in lines:
+            logger.log(logging.WARNING, "trace: %s", line)
+        return lines
+
+
+TRACE = ProtocolTrace()
+
+
+def open_capture(path, mode="r"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def read_capture(path):
+    """
+    Yield (timestamp, line) from a capture file, the timestamp is None
+    for lines without one. A capture that wasn't closed properly ends
+    with the last complete line.
+    """
+    with open_capture(path) as f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    # cut off in the middle of a line
+                    break
+                line = line.rstrip("\n")
+                if not line or line.startswith("#"):
+                    continue
+                ts = None
+                if "\t" in line:
+                    stamp, line = line.split("\t", 1)
+                    ts = float(stamp)
+                yield ts, line
+        except EOFError:
+            # gzip file without its trailer
+            logging.warning("%s is truncated", path)
+
+
+class ProtocolCapture():
+    """
+    Writes received protocol lines with timestamps to a file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open_capture(path, "w")
+        self.file.write("# LMS CLI capture, started {}\n".format(
+            time.strftime("%Y-%m-%d %H:%M:%S")))
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.lines = 0
+
+    def write(self, line):
+        with self.lock:
+            if self.file is not None:
+                self.file.write("{:.4f}\t{}\n".format(
+                    time.monotonic() - self.start, line))
+                self.lines += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# set by start_capture(), checked for every received line
+CAPTURE = None
+
+
+def start_capture(path):
+    global CAPTURE
+    stop_capture()
+    CAPTURE = ProtocolCapture(path)
+    logging.info("capturing LMS protocol to %s", path)
+    return CAPTURE
+
+
+def stop_capture():
+    global CAPTURE
+    capture = CAPTURE
+    CAPTURE = None
+    if capture is not None:
+        capture.close()
+        logging.info("captured %s lines to %s", capture.lines, capture.path)